@@ -1,11 +1,28 @@
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import logging
+import sys
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
 import re
-import unicodedata
 from urllib.parse import urlparse
 import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import TTLCache
+from cart_store import CartStore
+from catalog import CatalogIndex, name_within, normalize  # one accent/case folding for the index and the cache keys
+from metrics import SIZE_BUCKETS, Registry, TraceIdFilter, new_trace, trace_id
+from retrieval import html_to_text, pack_context, split_passages
 
 # Load environment variables
 load_dotenv()
@@ -14,256 +31,620 @@ load_dotenv()
 BRAVE_API_KEY = os.getenv("BRAVE_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-# Set up Gemini
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Upstream addresses; override them to run against other environments or the local stubs in loadtest.py
+CRU_BASE_URL = os.getenv("CRU_BASE_URL", "https://uk.crustaging.com").rstrip('/')
+BRAVE_SEARCH_URL = os.getenv("BRAVE_SEARCH_URL", "https://api.search.brave.com/res/v1/web/search")
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")  # e.g. http://127.0.0.1:8084, talked to over REST
 
-# Normalize text function
-def normalize(text):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', text)
-        if unicodedata.category(c) != 'Mn'
-    ).lower().strip()
+# Set up Gemini
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GEMINI_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = 'gemini-2.0-flash'
+model = genai.GenerativeModel(GEMINI_MODEL)
+
+# Diagnostics go to stderr through logging, tagged with the request's trace id (LOG_LEVEL=DEBUG shows everything),
+# and every stage and upstream call is timed into `metrics`
+log = logging.getLogger("wine")
+metrics = Registry(prefix='wine_')
+
+def setup_logging(level):
+    handler = logging.StreamHandler()
+    handler.addFilter(TraceIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(trace_id)s] %(message)s"))
+    log.handlers[:] = [handler]
+    log.setLevel(level)
+    log.propagate = False
+
+setup_logging(os.getenv("LOG_LEVEL", "WARNING").upper())
+
+# Shared HTTP session: one keep-alive connection pool, default headers/cookies and retries for every upstream
+DEFAULT_HEADERS = {'User-Agent': 'cru-script'}
+CRU_COOKIES = {
+    'frontend': 'mgmc90d0b0io1vbceg0sh8nbl9',
+    'frontend_cid': 'SK9WNt8zBeqmbFIZ',
+    'session_hash': '29983',
+    'CACHED_FRONT_FORM_KEY': 'RZWBEWMAUGMO5qqo'
+}
+# (connect, read) timeouts in seconds per upstream, so one stalled server can't hang a worker forever.
+# They apply to every attempt, so a GET can take (HTTP_RETRIES + 1) * (connect + read) plus the backoff
+# sleeps (0, then at most 0.8s): 3 * 3.55 + 0.8 = 11.45s fits the 12s search/web stage deadlines below,
+# 3 * 5.55 + 0.8 = 17.45s the 18s PDP one. Add-to-cart is never retried and gets the 25s cart deadline.
+HTTP_TIMEOUTS = {
+    'brave': (1.05, 2.5),
+    'autosuggest': (1.05, 2.5),
+    'pdp': (1.05, 4.5),
+    'cart': (3.05, 20),
+    'page': (3.05, 5),
+}
+HTTP_RETRIES = 2
+
+def create_http_session():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}),  # only idempotent calls are replayed; add-to-cart never is
+        backoff_factor=0.3,
+        backoff_jitter=0.2,                   # spread retries out so workers don't retry in lockstep
+        respect_retry_after_header=False,     # a long Retry-After would blow the stage deadline anyway
+        raise_on_status=False,                # hand the last response back so callers still see the status code
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    for name, value in CRU_COOKIES.items():
+        session.cookies.set(name, value, domain=urlparse(CRU_BASE_URL).hostname)
+    return session
+
+http = create_http_session()
+
+# Result pages come from any host, so they get their own session: in the shared one every new page host would
+# push the keep-alive pools of the wine API and Brave out of its cache. No retries, PAGE_DEADLINE is short.
+def create_page_session():
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=4, max_retries=0)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+page_http = create_page_session()
+
+# Requests per second allowed per upstream service, shared by all threads (0 = unlimited).
+# The wine API covers autosuggest, PDP and add-to-cart; web is the result pages fetched for context.
+RATE_LIMITS = {
+    'brave': float(os.getenv("BRAVE_RPS", 1)),
+    'wine': float(os.getenv("WINE_API_RPS", 10)),
+    'gemini': float(os.getenv("GEMINI_RPS", 5)),
+    'web': float(os.getenv("WEB_RPS", 0)),
+}
+HTTP_SERVICES = {'brave': 'brave', 'autosuggest': 'wine', 'pdp': 'wine', 'cart': 'wine', 'page': 'web'}
+
+class RateLimiter:
+    # each caller reserves the next free slot and sleeps until it, so calls are spaced 1/rate apart
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1 / self.rate
+        time.sleep(slot - now)
+
+rate_limiters = {name: RateLimiter(rps) for name, rps in RATE_LIMITS.items()}
+
+def http_request(method, upstream, url, headers=None, **kwargs):
+    service = HTTP_SERVICES[upstream]
+    with metrics.timer('rate_limit_wait_seconds', service=service):
+        rate_limiters[service].wait()
+    headers = {**(headers or {}), 'X-Request-ID': trace_id.get()}
+    with metrics.timer('upstream_seconds', upstream=upstream):
+        session = page_http if upstream == 'page' else http
+        response = session.request(method, url, headers=headers, timeout=HTTP_TIMEOUTS[upstream], **kwargs)
+    metrics.inc('upstream_responses_total', upstream=upstream, status=response.status_code)
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metrics.inc('upstream_retries_total', len(retries.history), upstream=upstream)
+    if not kwargs.get('stream'):  # a streamed body is read, and measured, by the caller
+        metrics.observe('upstream_response_bytes', len(response.content), SIZE_BUCKETS, upstream=upstream)
+    log.debug("%s %s %s -> %s", method, upstream, url, response.status_code)
+    return response
+
+def http_get(upstream, url, **kwargs):
+    return http_request('GET', upstream, url, **kwargs)
+
+def http_post(upstream, url, **kwargs):
+    return http_request('POST', upstream, url, **kwargs)
+
+# Response caches: catalogue search results change slowly, PDP data carries stock levels so it expires
+# quickly. Set CRU_CACHE_DB to a file path to keep both across restarts.
+CACHE_DB = os.getenv("CRU_CACHE_DB")
+search_cache = TTLCache('autosuggest', maxsize=512, ttl=600, stale_ttl=3600, path=CACHE_DB)
+pdp_cache = TTLCache('pdp', maxsize=512, ttl=60, stale_ttl=300, path=CACHE_DB)
+
+# Local product index, fed by every search result we see and optionally preloaded from a catalogue
+# export (JSON lines with at least lwin, name and url). A confident local match skips the remote search.
+catalog = CatalogIndex(os.getenv("CRU_CATALOG"))
+LOCAL_MATCH_SCORE = 0.9  # best local score needed to skip the autosuggest call (with no extra words in its name)
+MIN_MATCH_SCORE = 0.6    # search results scoring below this don't count as the wine asked for
+
+# Gemini response cache, keyed on model + normalized prompt. Prompts embed the product data, so a
+# stock change is a new key anyway. Answers about actions with side effects are never replayed.
+gemini_cache = TTLCache('gemini', maxsize=1024, ttl=1800, path=CACHE_DB)
+UNCACHED_INTENTS = {"add_to_cart"}
+
+def cache_metrics():
+    series = []
+    for cache in (search_cache, pdp_cache, gemini_cache):
+        stats = cache.stats()
+        labels = {'cache': stats['name']}
+        series += [
+            ('cache_hits_total', labels, stats['hits']),
+            ('cache_stale_hits_total', labels, stats['stale_hits']),
+            ('cache_misses_total', labels, stats['misses']),
+            ('cache_entries', labels, stats['size']),
+        ]
+    return series
+
+metrics.add_collector(cache_metrics)
+
+# Carts are kept per session id; set CRU_CART_DB to a file path so they survive restarts
+carts = CartStore(os.getenv("CRU_CART_DB"))
+DEFAULT_SESSION = os.getenv("CRU_SESSION", "default")
+
+# Print Gemini answers as they stream in instead of after the last token (GEMINI_STREAM=0 turns it off)
+STREAM_GEMINI = os.getenv("GEMINI_STREAM", "1") != "0"
+
+def generate_text(prompt, intent=None, on_chunk=None):
+    # with on_chunk, text is passed to it piece by piece as Gemini produces it; the full text is returned either way
+    start = time.perf_counter()
+    first = []
+
+    def emit(text):
+        if not first:
+            first.append(time.perf_counter() - start)
+        if on_chunk:
+            on_chunk(text)
+
+    def fetch():
+        with metrics.timer('rate_limit_wait_seconds', service='gemini'):
+            rate_limiters['gemini'].wait()
+        metrics.inc('gemini_calls_total', streamed=on_chunk is not None)
+        if on_chunk is None:
+            text = model.generate_content(prompt).text
+            emit(text)
+            return text
+        parts = []
+        for chunk in model.generate_content(prompt, stream=True):
+            parts.append(chunk.text)
+            emit(chunk.text)
+        return ''.join(parts)
+
+    with metrics.timer('stage_seconds', stage='gemini'):
+        if intent in UNCACHED_INTENTS:
+            text = fetch()
+        else:
+            key = hashlib.sha256(' '.join(normalize(prompt).split()).encode('utf-8')).hexdigest()
+            text = gemini_cache.get_or_fetch((GEMINI_MODEL, key), fetch)
+    if first:
+        metrics.observe('gemini_ttft_seconds', first[0])
+        metrics.observe('gemini_prompt_chars', len(prompt), SIZE_BUCKETS)
+    else:
+        emit(text)  # a cached answer arrives all at once
+    return text
+
+def print_streamed(generate, *args):
+    # print the answer while it streams; whatever didn't come through the stream (errors, canned replies) is printed after
+    streamed = []
+    start = time.perf_counter()
+
+    def show(text):
+        if not streamed:
+            streamed.append(time.perf_counter() - start)
+        streamed.append(text)
+        print(text, end='', flush=True)
+
+    output = generate(*args, on_chunk=show if STREAM_GEMINI else None)
+    if len(streamed) > 1:
+        print()
+    if output and output.strip() != ''.join(streamed[1:]).strip():
+        print(output)
+    if streamed:
+        print(f"⏱️ first chunk after {streamed[0]:.2f}s, done in {time.perf_counter() - start:.2f}s")
+    return output
+
+# Web context for general questions: every Brave result (one per domain) and, optionally, the result pages
+# themselves, cut down to the passages most relevant to the query within a token budget
+BRAVE_RESULT_COUNT = 5
+FETCH_RESULT_PAGES = os.getenv("FETCH_RESULT_PAGES", "1") != "0"
+PAGE_DEADLINE = 4            # seconds for all result pages together; slower ones are left out
+MAX_PAGE_BYTES = 500_000     # of HTML read per page; the rest isn't downloaded
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
 
 # Function to perform Brave Search
 def brave_search(query):
-    url = "https://api.search.brave.com/res/v1/web/search"
+    url = BRAVE_SEARCH_URL
     headers = {
         "Accept": "application/json",
         "X-Subscription-Token": BRAVE_API_KEY
     }
     params = {
         "q": query,
-        "count": 3,
+        "count": BRAVE_RESULT_COUNT,
         "freshness": "week"
     }
-    response = requests.get(url, headers=headers, params=params)
-    
+    try:
+        response = http_get('brave', url, headers=headers, params=params)
+    except requests.RequestException as e:
+        log.warning("❌ Error with Brave Search: %s", e)
+        return None
+
     if response.status_code == 200:
         return response.json()
     else:
-        print("❌ Error with Brave Search:", response.status_code)
+        log.warning("❌ Error with Brave Search: %s", response.status_code)
         return None
 
-# Function to query Gemini using search result
-def query_gemini(prompt):
+def fetch_page(url):
+    # streamed, so a PDF or a huge page is turned away on its headers or cut off after MAX_PAGE_BYTES
+    with http_get('page', url, headers={'Accept': 'text/html'}, stream=True) as response:
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code != 200 or 'html' not in content_type:
+            return ''
+        body = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            body += chunk
+            if len(body) >= MAX_PAGE_BYTES:
+                break
+    metrics.observe('upstream_response_bytes', len(body), SIZE_BUCKETS, upstream='page')
+    # requests assumes ISO-8859-1 for text/html without a charset, but such pages are mostly UTF-8
+    # that only say so in a <meta> tag
+    charset = re.search(r'charset=["\']?([\w.:-]+)', content_type, re.IGNORECASE)
     try:
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        print("❌ Error querying Gemini:\n", e)
-        return None
-
-# Main logic to handle query and fetch results
-def search_and_generate_response(query):
+        text = bytes(body[:MAX_PAGE_BYTES]).decode(charset.group(1) if charset else 'utf-8', errors='replace')
+    except LookupError:  # a charset Python doesn't know
+        text = bytes(body[:MAX_PAGE_BYTES]).decode('utf-8', errors='replace')
+    return html_to_text(text)
+
+def build_web_context(query, search_results):
+    with metrics.timer('stage_seconds', stage='context'):
+        return _build_web_context(query, search_results)
+
+def _build_web_context(query, search_results):
+    # keep the first (best-ranked) result per domain
+    results, domains = [], set()
+    for result in search_results.get('web', {}).get('results', []):
+        domain = urlparse(result.get('url', '')).netloc.lower().removeprefix('www.')
+        if domain and domain not in domains:
+            domains.add(domain)
+            results.append(result)
+    sources = [{
+        'title': r.get('title'),
+        'url': r.get('url'),
+        'snippets': [r.get('description', '')] + r.get('extra_snippets', []),
+        'passages': [],
+    } for r in results]
+
+    if FETCH_RESULT_PAGES and sources:
+        pool = ThreadPoolExecutor(len(sources))
+        # (copy the context so page fetches carry this request's trace id)
+        futures = {pool.submit(contextvars.copy_context().run, fetch_page, source['url']): source for source in sources}
+        done, _ = wait(futures, timeout=PAGE_DEADLINE)
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future in done:
+            if future.exception() is None:
+                futures[future]['passages'] = split_passages(future.result())
+        log.debug("📄 Fetched %d/%d result pages", sum(bool(s['passages']) for s in sources), len(sources))
+
+    return pack_context(query, sources, CONTEXT_TOKEN_BUDGET)
+
+# Web stage of a general question: (packed context, the sources it numbers), or None without results
+def search_web_context(query):
     search_results = brave_search(query)
-
-    if search_results and 'web' in search_results and 'results' in search_results['web']:
-        top_result = search_results['web']['results'][0]
-        title = top_result.get('title')
-        url = top_result.get('url')
-        description = top_result.get('description', 'No description available')
-
-        print("\n🌐 Brave Search Top Result:")
-        print(f"🔹 Title: {title}")
-        print(f"🔗 URL: {url}")
-        print(f"📝 Snippet: {description}")
-
-        gemini_prompt = (
-            f"Based on this web search result:\nTitle: {title}\nURL: {url}\n"
-            f"Snippet: {description}\n\n"
-            f"Give a useful and updated answer to this query: '{query}'"
-        )
-        gemini_response = query_gemini(gemini_prompt)
-
-        if gemini_response:
-            print("\n🧠 Gemini Response (Generated using Brave result):\n", gemini_response)
-        else:
-            print("❌ No response from Gemini.")
-    else:
-        print("❌ No search results from Brave Search.")
+    if not search_results or not search_results.get('web', {}).get('results'):
+        return None
+    return build_web_context(query, search_results)
 
 
 def extract_wine_info(query):
-    # Try to extract number of cases and bottles per case from the format like "2 cases ... (6x75cl)"
-    case_match = re.search(r'(\d+)\s+cases?.*?\((\d+)x75cl\)', query, re.IGNORECASE)
-    if case_match:
+    # Try to extract number of cases and bottles per case from the format like "2 cases ... (6x75cl)",
+    # or a plain "6 bottles of ...". For "2 cases of ..." without a format only the cases are known;
+    # the case size comes from the product's format once it's found (total_bottles is None until then)
+    case_match = re.search(r'(\d+)\s+cases?\b(?:.*?\((\d+)x75cl\))?', query, re.IGNORECASE)
+    bottle_match = re.search(r'(\d+)\s+bottles?\b', query, re.IGNORECASE)
+    num_cases = None
+    if case_match and case_match.group(2):
+        total_bottles = int(case_match.group(1)) * int(case_match.group(2))
+    elif case_match:
         num_cases = int(case_match.group(1))
-        bottles_per_case = int(case_match.group(2))
-        total_bottles = num_cases * bottles_per_case
+        total_bottles = None
+    elif bottle_match:
+        total_bottles = int(bottle_match.group(1))
     else:
         # Fallback: assume 1 bottle if nothing is mentioned
         total_bottles = 1
 
     # Try to remove "Add ... to my cart" and clean up the wine name
-    wine_name_match = re.search(r'(?:add\s*\d+\s*cases?\s*of\s+)?(.+?)(?:\s*\(\d+x75cl\))?(?:\s*to\s+my\s+cart)?$', query, re.IGNORECASE)
+    wine_name_match = re.search(r'(?:(?:add|buy|purchase)\s*\d+\s*(?:cases?|bottles?)\s*of\s+)?(.+?)(?:\s*\(\d+x75cl\))?(?:\s*to\s+my\s+cart)?$', query, re.IGNORECASE)
     if wine_name_match:
         wine_name_cleaned = wine_name_match.group(1).strip()
     else:
         wine_name_cleaned = query.strip()  # fallback to full query
 
-    print("User query:", query)
-    print("Wine name:", wine_name_cleaned, "| Total bottles:", total_bottles)
+    log.debug("User query: %s | Wine name: %s | Total bottles: %s | Cases: %s",
+              query, wine_name_cleaned, total_bottles, num_cases)
 
     return {
         "name": wine_name_cleaned,
-        "total_bottles": total_bottles
+        "total_bottles": total_bottles,
+        "cases": num_cases
     }    
     return None, None
 
+def extract_wine_items(query):
+    # "Add 2 cases of X (6x75cl) and 3 cases of Y (12x75cl) to my cart" -> one item per wine.
+    # Only split where a new quantity starts, so names with "and" in them stay whole.
+    order = re.sub(r'\s*to\s+my\s+cart\s*$', '', query.strip(), flags=re.IGNORECASE)
+    order = re.sub(r'^(?:add|buy|purchase)\s+', '', order, flags=re.IGNORECASE)
+    parts = re.split(r'\s*(?:,|\band\b)\s*(?=\d+\s+(?:cases?|bottles?)\b)', order, flags=re.IGNORECASE)
+    if len(parts) < 2:
+        return [extract_wine_info(query)]
+    return [extract_wine_info(f"add {part.strip()} to my cart") for part in parts]
+
+
+# Async pipeline: search -> PDP -> cart. Blocking calls run in worker threads over the shared session,
+# several PDP lookups go out at once and every stage has its own deadline (seconds; HTTP_TIMEOUTS fit inside)
+STAGE_DEADLINES = {
+    'search': 12,
+    'web': 16,  # Brave (up to 11.45s with retries) and then the result pages (PAGE_DEADLINE)
+    'pdp': 18,
+    'cart': 25,
+}
+MAX_PDP_CANDIDATES = 3  # matching products whose details are fetched concurrently
+# Stage calls run on this long-lived pool rather than the event loop's default executor: asyncio.run() joins
+# that one before returning, so a call past its deadline would still hold up the answer until it finished
+stage_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='stage')
+
+async def run_stage(stage, func, *args):
+    with metrics.timer('stage_seconds', stage=stage):
+        # (copy the context so the call carries this request's trace id)
+        call = asyncio.get_running_loop().run_in_executor(stage_pool, contextvars.copy_context().run, func, *args)
+        return await asyncio.wait_for(call, STAGE_DEADLINES[stage])
+
+def search_products(wine_name):
+    return search_cache.get_or_fetch(normalize(wine_name), lambda: fetch_products(wine_name))
+
+def fetch_products(wine_name):
+    url = f'{CRU_BASE_URL}/live-markets/api_buyBid/autosuggestionsearch'
+    params = {
+        'q': wine_name,
+        'exactStockAvailable': 'undefined',
+        'limit': 10,
+        'searchProducers': 'true',
+        'platform': 'web'
+    }
 
-# Main function to get wine details and attempt add-to-cart
-def get_wine_details_tool(query):
-    wine_info = extract_wine_info(query)
+    response = http_get('autosuggest', url, params=params)
+
+    if response.status_code != 200:
+        raise RuntimeError(f"API returned error code {response.status_code}")
+
+    products = response.json()
+    if not products.get('found'):
+        return []
+    return [
+        product
+        for item in products.get('data', []) if item.get('type') == 'product'
+        for product in item.get('data', [])
+    ]
+
+def product_req_path(product):
+    url = product.get('url', '')
+    return url.split('/')[3].lstrip('/') if '/' in url else ''
+
+def format_wine_data(details, web_context=None):
+    wines = []
+    for product, detail in details:
+        _, product_id, qty_available, name, description, image, stock_location, stock_location_eta, _ = detail
+        wines.append({
+            "name": name,
+            "lwin": product.get('lwin'),
+            "product_id": product_id,
+            "qty_available": qty_available,
+            "description": description,
+            "image_url": image,
+            "stock_location": stock_location,
+            "stock_location_eta": stock_location_eta
+        })
+    data = {"wines": wines}
+    if web_context:
+        context, sources = web_context
+        data["web_context"] = context
+        data["web_sources"] = [{"n": n, "title": s.get('title'), "url": s.get('url')} for n, s in enumerate(sources, 1)]
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+async def get_wine_details_async(query, intent=None, session=DEFAULT_SESSION):
+    intent = intent or classify_user_intent(query)
+    if intent != "add_to_cart":
+        return await resolve_wine(query, extract_wine_info(query), intent, session)
+
+    # every wine in the order is resolved and added at the same time
+    items = extract_wine_items(query)
+    results = await asyncio.gather(*(resolve_wine(query, item, intent, session) for item in items))
+    response = "\n".join(results)
+    if any(r.startswith("✅") for r in results):
+        response += "\n\n🛒 Current Cart:\n" + json.dumps(carts.items(session), indent=2)
+    return response
+
+async def resolve_wine(query, wine_info, intent, session):
     wine_name = wine_info["name"]
     quantity = wine_info["total_bottles"]
-
-    print("Wine name:", wine_name, "| Quantity:", quantity)
-
+    cases = wine_info.get("cases")  # set when the order gave cases but no format
+
+    log.info("Wine name: %s | Quantity: %s | Cases: %s", wine_name, quantity, cases)
+
+    # stage 1: resolve the wine from the local index when it's confident, otherwise search the
+    # catalogue remotely; the web search runs alongside when the answer mixes both.
+    # What goes in the cart always comes from a fresh search.
+    local = [(score, p) for score, p in catalog.search(wine_name, MAX_PDP_CANDIDATES) if p.get('url')]
+    confident = (intent != "add_to_cart" and local and local[0][0] >= LOCAL_MATCH_SCORE
+                 and name_within(wine_name, local[0][1]))
+    stage = {}
+    if not confident:
+        stage['products'] = run_stage('search', search_products, wine_name)
+    if intent == "general":
+        stage['web'] = run_stage('web', search_web_context, query)
+    results = dict(zip(stage, await asyncio.gather(*stage.values(), return_exceptions=True)))
+    web_context = results.get('web')
+    if isinstance(web_context, BaseException):
+        web_context = None
+
+    def no_wine(message):
+        # a general question can still be answered from the web when no wine comes of it
+        return format_wine_data([], web_context) if web_context else message
+
+    if 'products' in results:
+        products = results['products']
+        if isinstance(products, asyncio.TimeoutError):
+            return no_wine(f"❌ Wine search timed out after {STAGE_DEADLINES['search']}s.")
+        if isinstance(products, BaseException):
+            return no_wine(f"❌ Error fetching wine details: {products}")
+
+        catalog.add(products)
+        linked = {str(p['lwin']) for p in products if p.get('lwin') and p.get('url')}
+        ranked = catalog.search(wine_name, MAX_PDP_CANDIDATES, among=linked)
+        candidates = [p for score, p in ranked if score >= MIN_MATCH_SCORE]
+        if not candidates:
+            unlinked = [p for p in products if normalize(wine_name) in normalize(p.get('name', ''))]
+            if unlinked:
+                return no_wine(f"❌ No LWIN or URL for product: {unlinked[0].get('name')}")
+            return no_wine(f"❌ No wine found matching '{wine_name}'.")
+    else:
+        log.debug("Resolved locally: %s", [p.get('name') for _, p in local])
+        candidates = [p for score, p in local if score >= MIN_MATCH_SCORE]
+
+    # stage 2: product details for every candidate at once, kept in search ranking order
+    # (stale stock levels are fine for answering questions, but not for deciding what goes in the cart)
+    results = await asyncio.gather(*(
+        run_stage('pdp', get_product_details_by_req_path, product_req_path(p), p['lwin'], intent != "add_to_cart",
+                  quantity or 1, cases)
+        for p in candidates
+    ), return_exceptions=True)
+    details = [(p, r) for p, r in zip(candidates, results) if isinstance(r, tuple)]
+    if not details:
+        if all(isinstance(r, asyncio.TimeoutError) for r in results):
+            return no_wine(f"❌ Product details timed out after {STAGE_DEADLINES['pdp']}s.")
+        return no_wine(f"❌ Could not fetch product details for '{wine_name}'.")
+
+    if intent != "add_to_cart":
+        return format_wine_data(details, web_context)
+
+    # stage 3: add the best-ranked candidate with an offer that covers the quantity (in bottles, detail[8])
+    available = [(p, detail) for p, detail in details if detail[1] and detail[8] and detail[2] >= detail[8]]
+    if not available:
+        if cases and not any(detail[8] for _, detail in details):
+            return (f"❌ The case size of '{wine_name}' isn't known. Please give the format, "
+                    f"e.g. 'add {cases} cases of {wine_name} (6x75cl) to my cart'.")
+        return "❌ Product is not available in the desired quantity."
+    product, detail = available[0]
     try:
-        url = 'https://uk.crustaging.com/live-markets/api_buyBid/autosuggestionsearch'
-        params = {
-            'q': wine_name,
-            'exactStockAvailable': 'undefined',
-            'limit': 10,
-            'searchProducers': 'true',
-            'platform': 'web'
-        }
-
-        headers = {'User-Agent': 'cru-script'}
-        cookies = {
-            'frontend': 'mgmc90d0b0io1vbceg0sh8nbl9',
-            'frontend_cid': 'SK9WNt8zBeqmbFIZ',
-            'session_hash': '29983',
-            'CACHED_FRONT_FORM_KEY': 'RZWBEWMAUGMO5qqo'
-        }
-
-        response = requests.get(url, headers=headers, cookies=cookies, params=params)
-        print("Search Status Code:", response.status_code)
-
-        if response.status_code != 200:
-            return f"❌ API returned error code {response.status_code}", None
-
-        products = response.json()
-        output = []
-
-        if products.get('found'):
-            found_wine = None
-            for item in products.get('data', []):
-                item_type = item.get('type')
-                entries = item.get('data', [])
-
-                if item_type == 'product':
-                    for product in entries:
-                        product_name = product.get('name', '').lower()
-                        if wine_name.lower() in product_name:  # Check if the extracted wine_name matches product name
-                            found_wine = product
-                            break
-                        
-                if found_wine:
-                    product_url = found_wine.get('url', '')
-                    lwin = found_wine.get('lwin', '')
-                    if lwin and product_url:
-                        req_path = product_url.split('/')[3] if '/' in product_url else ''
-                        (
-                            product_detail,
-                            product_id,
-                            qty_available,
-                            wine_name,
-                            wine_description,
-                            wine_image,
-                            stock_location,
-                            stock_location_eta
-                        ) = get_product_details_by_req_path(req_path, lwin)
-
-                        if product_id:
-                            # 🔽 Replace the original add_to_cart() call with this:
-                            cart_response, current_cart = add_to_cart(
-                                                    product_id,
-                                                    quantity
-                                                )
-
-                            # 🔽 Return both the response and the current cart details
-                            return f"{cart_response}\n\n🛒 Current Cart:\n" + json.dumps(current_cart, indent=2)
-                        else:
-                            return "❌ Product is not available in the desired quantity."
-                    else:
-                        output.append(f"❌ No LWIN or URL for product: {found_wine.get('name')}")
-                    break
-
-            if not found_wine:
-                return f"❌ No wine found matching '{wine_name}'.", None
-
-            return "\n".join(output)
-        else:
-            return f"❌ No wine found matching '{wine_name}'.", None
+        cart_response, _ = await run_stage('cart', add_to_cart, detail[1], detail[8], session)
+    except asyncio.TimeoutError:
+        return f"❌ Add to cart timed out after {STAGE_DEADLINES['cart']}s."
+    finally:
+        # the stock level we cached for this product is out of date now
+        pdp_cache.invalidate((product_req_path(product), product['lwin']))
+    return cart_response
+
+# Sync entry point for the interactive loop
+def get_wine_details_tool(query, intent=None, session=DEFAULT_SESSION):
+    try:
+        return asyncio.run(get_wine_details_async(query, intent, session))
     except Exception as e:
-        return f"❌ Error fetching wine details: {e}", None
+        return f"❌ Error fetching wine details: {e}"
 
 
 
 # Function to get product details from PDP API and attempt add-to-cart
-def get_product_details_by_req_path(req_path, lwin):
+def fetch_product_detail(url):
+    response = http_get('pdp', url)
+
+    if response.status_code != 200:
+        log.warning("Product detail API error %s: %s", response.status_code, response.text)
+        raise RuntimeError(f"Product detail API returned error {response.status_code}")
+    return response.json()
+
+def case_size(*sources):
+    # bottles per case from a "6x75cl"-style format on the offer or the product
+    for source in sources:
+        match = re.match(r'\s*(\d+)\s*x', str(source.get('format') or ''))
+        if match:
+            return int(match.group(1))
+    return None
+
+def get_product_details_by_req_path(req_path, lwin, allow_stale=True, quantity=1, cases=None):
+    # with cases, the bottles wanted depend on each offer's case size; offers without a known one are skipped
     try:
         if not req_path or not lwin:
             return "❌ req_path or lwin is missing."
 
         req_path = req_path.lstrip('/')
-        url = f"https://uk.crustaging.com/live-markets/api_pdp/get?req_path={req_path}&lwin={lwin}&offer_type=cru&selected_transfer_type=storage&platform=web"
-        print(f"Product Detail API URL: {url}")
-
-        headers = {
-            'User-Agent': 'cru-script'
-        }
+        url = f"{CRU_BASE_URL}/live-markets/api_pdp/get?req_path={req_path}&lwin={lwin}&offer_type=cru&selected_transfer_type=storage&platform=web"
 
-        response = requests.get(url, headers=headers)
-        print("Status Code (Product Details):", response.status_code)
-
-        if response.status_code != 200:
-            print(f"Error Details: {response.text}")
-            return f"❌ Product detail API returned error {response.status_code}"
-
-        product_detail = response.json()
+        try:
+            product_detail = pdp_cache.get_or_fetch((req_path, lwin), lambda: fetch_product_detail(url), allow_stale)
+        except RuntimeError as e:
+            return f"❌ {e}"
 
         # Extract main product details
-        if 'main_details' in product_detail and product_detail['main_details']:
-            main_details = product_detail['main_details']
+        main_details = product_detail.get('main_details') or {}
+        if main_details:
             wine_name = main_details.get('short_name', 'No short name')
             wine_description = main_details.get('description', 'No description available')
             wine_image = main_details.get('image_url', 'No image available')
             stock_location = main_details.get('stock_location', 'No stock location')
             stock_location_eta = main_details.get('stock_location_eta', 'No ETA available')
 
-            print("Wine Name:", wine_name)
-            print("Description:", wine_description)
-            print("Image URL:", wine_image)
-            print("Stock Location:", stock_location)
-            print("Stock Location ETA:", stock_location_eta)
+            log.debug("Wine Name: %s | Image URL: %s | Stock Location: %s | ETA: %s",
+                      wine_name, wine_image, stock_location, stock_location_eta)
 
+        # the first offer with at least `quantity` available; failing that, the one with the most stock
         buy_details = product_detail.get('buy_details', [])
-        product_found = False
+        product_id, qty_available, bottles = None, 0, None
 
         for item in buy_details:
-            product_id = item.get('product_id')
+            offer_id = item.get('product_id')
             unit_qty_info = item.get('unit_qty_info', {})
             qty_available_raw = unit_qty_info.get('qty_available')
 
             try:
-                qty_available = int(qty_available_raw)
+                offer_qty = int(qty_available_raw)
             except (ValueError, TypeError):
-                qty_available = 0
+                offer_qty = 0
 
-            print("  DEBUG:", {
-                "product_id": product_id,
-                "qty_available": qty_available
-            })
+            log.debug("buy_details: product_id=%s qty_available=%s", offer_id, offer_qty)
 
-            if product_id and qty_available and qty_available > 0:
-                print("Product available to add to cart:")
-                print(f"PRODUCT ID: {product_id}")
-                print(f"Qty Available: {qty_available}")
-                product_found = True
-                # return product_detail, product_id
+            if not offer_id:
+                continue
+            wanted = quantity
+            if cases is not None:
+                size = case_size(item, main_details)
+                if size is None:
+                    continue
+                wanted = cases * size
+            if offer_qty >= wanted:
+                product_id, qty_available, bottles = offer_id, offer_qty, wanted
+                break
+            if product_id is None or offer_qty > qty_available:
+                product_id, qty_available, bottles = offer_id, offer_qty, wanted
 
         return (
             product_detail,
@@ -273,19 +654,18 @@ def get_product_details_by_req_path(req_path, lwin):
             wine_description,
             wine_image,
             stock_location,
-            stock_location_eta
+            stock_location_eta,
+            bottles
         )
 
 
     except Exception as e:
-        print(f" Error fetching product details: {e}")
+        log.warning("Error fetching product details: %s", e)
         return {}
 
 # function for add-to-cart
-cart = []
-
-def add_to_cart(product_id, quantity):
-    add_to_cart_url = "https://uk.crustaging.com/live-markets/api_cart/addToCart"
+def add_to_cart(product_id, quantity, session=DEFAULT_SESSION):
+    add_to_cart_url = f"{CRU_BASE_URL}/live-markets/api_cart/addToCart"
     
     payload = {
         "availability": "available",  
@@ -298,19 +678,13 @@ def add_to_cart(product_id, quantity):
         "uenc": "",  
     }
 
-    headers = {
-        "Content-Type": "application/json",
-        "User-Agent": "cru-script"
-    }
-
     try:
-        response = requests.post(add_to_cart_url, headers=headers, json=payload)
-        print("Add to Cart Status:", response.status_code)
+        response = http_post('cart', add_to_cart_url, json=payload)
 
         if response.status_code == 200:
             try:
                 response_data = response.json()
-                print("🧾 Add-to-Cart API Response:", response_data)
+                log.debug("🧾 Add-to-Cart API Response: %s", response_data)
 
                 if response_data.get("status") == 1:
                     cart_item = response_data.get("cart_items", [])[0]
@@ -328,13 +702,10 @@ def add_to_cart(product_id, quantity):
                         "format": cart_item.get("format"),
                         "quantity": quantity
                     }
-                    cart.append(cart_item_data)
-
-                    print("\n🛒 Current Cart Items:")
-                    for item in cart:
-                        print(item)
+                    line = carts.add(session, cart_item_data)
+                    log.info("🛒 Cart line: %s", line)
 
-                    return f"✅ Successfully added {quantity}x {cart_item_data['product_name']} to cart.", cart
+                    return f"✅ Successfully added {quantity}x {cart_item_data['product_name']} to cart.", carts.items(session)
                 else:
                     return f"❌ API responded but did not confirm success: {response_data}", None
             except ValueError:
@@ -364,7 +735,7 @@ def classify_user_intent(query):
         return "general"
 
 
-def generate_gemini_response_from_wine_data(query, wine_data_formatted):
+def generate_gemini_response_from_wine_data(query, wine_data_formatted, on_chunk=None, session=DEFAULT_SESSION):
     intent = classify_user_intent(query)
     prompt = ""
 
@@ -393,22 +764,23 @@ def generate_gemini_response_from_wine_data(query, wine_data_formatted):
             f"Please call the search API, then PDP API, and then add the product to the cart."
         )
     elif intent == "show_cart":
-        if not cart:
+        items = carts.items(session)
+        if not items:
             return "🛒 Your cart is empty."
         response = "🛒 **Your Cart:**\n"
-        for item in cart:
-            response += f"- {item['quantity']}x {item['name'].title()}\n"
+        for item in items:
+            response += f"- {item['quantity']}x {(item['product_name'] or '').title()}\n"
         return response
     else:
         prompt = (
             f"User asked: '{query}'\n\n"
             f"🍷 Wine Product Data from API:\n{wine_data_formatted}\n\n"
-            f"Now write a helpful, friendly response to the user, combining both the web and wine product data."
+            f"Now write a helpful, friendly response to the user, combining both the web and wine product data. "
+            f"Cite the web sources you use as [n]."
         )
 
     try:
-        response = model.generate_content(prompt)
-        return (response.text.strip())
+        return generate_text(prompt, intent, on_chunk).strip()
     except Exception as e:
         return f"❌ Gemini generation error: {e}"
     
@@ -420,30 +792,162 @@ def interactive_query():
         if user_query.lower() == 'exit':
             print("👋 Exiting...")
             break
+        if user_query.lower() == 'stats':
+            print(metrics.summary())
+            print(json.dumps([c.stats() for c in (search_cache, pdp_cache, gemini_cache)], indent=2))
+            continue
+        new_trace()
+        with metrics.timer('stage_seconds', stage='request'):
+            handle_query(user_query)
+
+def handle_query(user_query):
+    with metrics.timer('stage_seconds', stage='intent'):
         intent = classify_user_intent(user_query)
 
-        if intent in ["stock", "description", "image", "add_to_cart", "general"]:
-            print(f"🍷 Gemini detected '{intent}' intent. Processing...")
+    if intent != "show_cart":
+        print(f"🍷 Gemini detected '{intent}' intent. Processing...")
 
-            wine_data = get_wine_details_tool(user_query)
+        wine_data = get_wine_details_tool(user_query, intent)
 
-            if not wine_data or (isinstance(wine_data, list) and not wine_data[0].strip()):
-                print("❌ Failed to get wine data or it was empty.")
-                continue
+        if not wine_data or not wine_data.strip():
+            print("❌ Failed to get wine data or it was empty.")
+            return
 
-            if intent == "add_to_cart" and isinstance(wine_data, str):
-                print(f"\n✅ Gemini Raw Add-to-Cart Result:\n{wine_data}")
-                wine_data_formatted = wine_data
+        if intent == "add_to_cart":
+            print(f"\n✅ Gemini Raw Add-to-Cart Result:\n{wine_data}")
+        wine_data_formatted = wine_data.strip()
+
+        print("\n🧠 Gemini Final Response:")
+        print_streamed(generate_gemini_response_from_wine_data, user_query, wine_data_formatted)
+
+        # the web results the answer's [n] citations refer to
+        try:
+            sources = json.loads(wine_data_formatted).get("web_sources", [])
+        except ValueError:
+            sources = []
+        if sources:
+            print("\n🌐 Sources:")
+        for source in sources:
+            print(f"🔹 [{source['n']}] {source['title']}")
+            print(f"🔗 URL: {source['url']}")
+
+    elif intent == "show_cart":
+        print(generate_gemini_response_from_wine_data(user_query, ""))
+
+# Batch mode: answer every query in a JSONL file with a pool of workers, one JSONL result per query
+def answer_query(query, session=DEFAULT_SESSION):
+    trace = new_trace()
+    start = time.perf_counter()
+    timings = {}
+    with metrics.timer('stage_seconds', stage='request'):
+        with metrics.timer('stage_seconds', stage='intent'):
+            intent = classify_user_intent(query)
+        wine_data = ""
+        if intent != "show_cart":
+            wine_data = get_wine_details_tool(query, intent, session).strip()
+            timings['details'] = time.perf_counter() - start
+        t = time.perf_counter()
+        response = generate_gemini_response_from_wine_data(query, wine_data, session=session)
+        timings['gemini'] = time.perf_counter() - t
+    timings['total'] = time.perf_counter() - start
+    return {"trace_id": trace, "intent": intent, "wine_data": wine_data, "response": response, "timings": timings}
+
+def answer_record(line_no, record):
+    result = {"line": line_no, **record}
+    try:
+        result.update(answer_query(record["query"], record.get("session", DEFAULT_SESSION)))
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+def run_batch(in_path, out_path, workers=8):
+    start = time.perf_counter()
+    done_count = errors = 0
+    with open(in_path, 'r', encoding='utf-8') as f, open(out_path, 'w', encoding='utf-8') as out, \
+            ThreadPoolExecutor(workers) as pool:
+
+        def write(results):
+            nonlocal done_count, errors
+            for result in results:
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                done_count += 1
+                errors += 'error' in result
+            out.flush()
+            print(f"\r{done_count} queries answered, {errors} errors", end='', file=sys.stderr, flush=True)
+
+        # queries are read as workers free up, so a file of thousands never sits in memory
+        pending = set()
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                # a bad line is reported like a failed query instead of ending the run
+                write([{"line": line_no, "error": f"{type(e).__name__}: {e}"}])
+                continue
+            if isinstance(record, str):
+                record = {"query": record}
+            pending.add(pool.submit(answer_record, line_no, record))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(future.result() for future in done)
+        write(future.result() for future in pending)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n✅ {done_count} queries in {elapsed:.1f}s ({done_count / elapsed:.2f}/s), results in {out_path}",
+          file=sys.stderr)
+    print(metrics.summary(), file=sys.stderr)
+
+# Metrics over HTTP: /metrics in the Prometheus text format, /metrics.json as a snapshot with percentiles
+def serve_metrics(port, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.snapshot()), 'application/json'
             else:
-                wine_data_formatted = wine_data[0].strip()
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
 
-            gemini_output = generate_gemini_response_from_wine_data(user_query, wine_data_formatted)
-            print("\n🧠 Gemini Final Response:\n", gemini_output)
+        def log_message(self, format, *args):
+            log.debug("metrics: " + format, *args)
 
-        else:
-            print("🌐 No wine-related intent. Handling with general Gemini + Brave logic...")
-            search_and_generate_response(user_query)
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 # # 🔥 Start the script
 if __name__ == "__main__":
-    interactive_query()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Wine assistant: interactive, or over a JSONL file of queries")
+    parser.add_argument('--batch', metavar='QUERIES_JSONL',
+                        help='one {"query": ..., "session": ...} object (or query string) per line')
+    parser.add_argument('--out', default='results.jsonl', help="where --batch writes one JSON result per query")
+    parser.add_argument('--workers', type=int, default=8, help="queries answered concurrently in --batch mode")
+    parser.add_argument('--brave-rps', type=float, default=RATE_LIMITS['brave'], help="Brave requests/sec (0 = no limit)")
+    parser.add_argument('--wine-rps', type=float, default=RATE_LIMITS['wine'], help="wine API requests/sec (0 = no limit)")
+    parser.add_argument('--gemini-rps', type=float, default=RATE_LIMITS['gemini'], help="Gemini calls/sec (0 = no limit)")
+    parser.add_argument('--web-rps', type=float, default=RATE_LIMITS['web'], help="result page fetches/sec (0 = no limit)")
+    parser.add_argument('--log-level', default=log.getEffectiveLevel(), type=str.upper,
+                        help="DEBUG shows every upstream call and payload (default from LOG_LEVEL, else WARNING)")
+    parser.add_argument('--metrics-port', type=int, help="serve /metrics (Prometheus) and /metrics.json on this port")
+    parser.add_argument('--metrics-out', help="write a JSON metrics snapshot here when --batch finishes")
+    args = parser.parse_args()
+    for name in RATE_LIMITS:
+        rate_limiters[name].rate = getattr(args, f"{name}_rps")
+    setup_logging(args.log_level)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    if args.batch:
+        run_batch(args.batch, args.out, args.workers)
+        if args.metrics_out:
+            with open(args.metrics_out, 'w', encoding='utf-8') as f:
+                json.dump(metrics.snapshot(), f, indent=2)
+    else:
+        interactive_query()
\ No newline at end of file
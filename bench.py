@@ -0,0 +1,133 @@
+"""
+Throughput benchmarks for chatgpt.py over a grid of model and batch shapes.
+
+    python bench.py --batch-size 32,64 --block-size 8,64 --n-embd 32,128 --n-head 4 --out bench.json
+
+For every configuration this measures training tokens/sec with a per-phase split
+(data, forward, backward, optimizer), the cost of one estimate_loss() call and
+generate() latency per token at several prompt lengths, with and without the
+KV cache. Each configuration runs in a fresh process so its peak RSS is its own.
+Results are printed and optionally written as JSON.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+
+import torch
+
+import chatgpt
+
+
+def sync():
+    if chatgpt.device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(config, steps, warmup, contexts, gen_tokens):
+    for k, v in config.items():
+        setattr(chatgpt, k, v)
+    torch.manual_seed(1337)
+    chatgpt.load_data()
+    chatgpt.init_samplers()
+    model = chatgpt.model = chatgpt.BigramLanguageModel(chatgpt.vocab_size).to(chatgpt.device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=chatgpt.learning_rate)
+
+    phases = dict.fromkeys(['data', 'forward', 'backward', 'optimizer'], 0.0)
+    for i in range(warmup + steps):
+        t0 = time.perf_counter()
+        xb, yb = chatgpt.get_batch('train')
+        t1 = time.perf_counter()
+        logits, loss = model(xb, yb)
+        sync()
+        t2 = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        sync()
+        t3 = time.perf_counter()
+        optimizer.step()
+        sync()
+        t4 = time.perf_counter()
+        if i >= warmup:
+            for phase, dt in zip(phases, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                phases[phase] += dt
+    step_time = sum(phases.values()) / steps
+
+    t0 = time.perf_counter()
+    chatgpt.estimate_loss()
+    estimate_loss_s = time.perf_counter() - t0
+    chatgpt.samplers['train'].close()
+
+    model.eval()
+    generate_ms = {}
+    for context in contexts:
+        prompt = torch.randint(chatgpt.vocab_size, (1, context), device=chatgpt.device)
+        generate_ms[context] = {}
+        for use_cache in (True, False):
+            t0 = time.perf_counter()
+            model.generate(prompt, gen_tokens, use_cache=use_cache)
+            sync()
+            generate_ms[context]['cached' if use_cache else 'uncached'] = 1000 * (time.perf_counter() - t0) / gen_tokens
+
+    return {
+        **config,
+        'params': sum(p.numel() for p in model.parameters()),
+        'train_tokens_per_sec': chatgpt.batch_size * chatgpt.block_size / step_time,
+        'step_ms': 1000 * step_time,
+        'phase_ms': {phase: 1000 * t / steps for phase, t in phases.items()},
+        'estimate_loss_s': estimate_loss_s,
+        'generate_ms_per_token': generate_ms,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # ru_maxrss is in KiB on Linux
+    }
+
+
+def ints(s):
+    return [int(x) for x in s.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark training, evaluation and generation throughput")
+    parser.add_argument('--batch-size', type=ints, default=[chatgpt.batch_size])
+    parser.add_argument('--block-size', type=ints, default=[chatgpt.block_size])
+    parser.add_argument('--n-embd', type=ints, default=[chatgpt.n_embd])
+    parser.add_argument('--n-head', type=ints, default=[chatgpt.n_head])
+    parser.add_argument('--steps', type=int, default=50, help="timed training steps per configuration")
+    parser.add_argument('--warmup', type=int, default=5, help="untimed training steps before measuring")
+    parser.add_argument('--contexts', type=ints, default=[1, 64, 256], help="prompt lengths for generate() latency")
+    parser.add_argument('--gen-tokens', type=int, default=100, help="tokens generated per latency measurement")
+    parser.add_argument('--out', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    configs = [dict(batch_size=b, block_size=t, n_embd=c, n_head=h)
+               for b, t, c, h in itertools.product(args.batch_size, args.block_size, args.n_embd, args.n_head)
+               if c % h == 0]
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for config in configs:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run, (config, args.steps, args.warmup, args.contexts, args.gen_tokens))
+        results.append(result)
+        print(f"{config}: {result['train_tokens_per_sec']:,.0f} tok/s train, "
+              f"estimate_loss {result['estimate_loss_s']:.2f}s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    report = {
+        'env': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'threads': torch.get_num_threads(),
+            'device': chatgpt.device,
+            'tokenizer': chatgpt.tokenizer,
+        },
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,107 @@
+"""
+Byte-level byte-pair-encoding tokenizer for chatgpt.py.
+
+Text is split into word-like chunks, each chunk starts out as its utf-8 bytes
+(ids 0..255) and learned merges fuse frequent neighbouring pairs into new ids.
+
+    tok = Tokenizer.train(['some text ...'], vocab_size=512)
+    ids = tok.encode("hello world")
+    tok.decode(ids) == "hello world"
+"""
+import re
+from collections import Counter, defaultdict
+
+# contractions, runs of letters, digits or other symbols (each with one leading space), and whitespace
+split_pattern = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+cache_size = 1 << 20 # encoded chunks kept around; words repeat a lot in natural text
+
+
+def merge(ids, pair, idx):
+    # replace every occurrence of pair in ids with the new token idx
+    out = []
+    i = 0
+    while i < len(ids):
+        if i + 1 < len(ids) and ids[i] == pair[0] and ids[i+1] == pair[1]:
+            out.append(idx)
+            i += 2
+        else:
+            out.append(ids[i])
+            i += 1
+    return out
+
+
+class Tokenizer:
+    """ byte-pair tokenizer: merges[i] is the pair of ids that becomes token 256 + i """
+
+    def __init__(self, merges=()):
+        self.merges = [tuple(pair) for pair in merges]
+        self.ranks = {pair: i for i, pair in enumerate(self.merges)}
+        self.vocab = [bytes([i]) for i in range(256)]
+        for a, b in self.merges:
+            self.vocab.append(self.vocab[a] + self.vocab[b])
+        self.cache = {}
+
+    @property
+    def vocab_size(self):
+        return len(self.vocab)
+
+    @classmethod
+    def train(cls, texts, vocab_size):
+        # count chunks once, then learn merges over the unique chunks weighted by frequency
+        words = Counter()
+        for text in texts:
+            words.update(split_pattern.findall(text))
+        seqs = [list(w.encode('utf-8')) for w in words]
+        freqs = list(words.values())
+
+        # pair counts are kept up to date incrementally: a merge only touches the words containing it
+        counts = Counter()
+        where = defaultdict(set)
+        for i, seq in enumerate(seqs):
+            for pair in zip(seq, seq[1:]):
+                counts[pair] += freqs[i]
+                where[pair].add(i)
+
+        merges = []
+        while 256 + len(merges) < vocab_size and counts:
+            pair = max(counts, key=counts.get)
+            idx = 256 + len(merges)
+            merges.append(pair)
+            for i in where.pop(pair):
+                seq, freq = seqs[i], freqs[i]
+                for p in zip(seq, seq[1:]):
+                    counts[p] -= freq
+                    if not counts[p]:
+                        del counts[p]
+                seq = seqs[i] = merge(seq, pair, idx)
+                for p in zip(seq, seq[1:]):
+                    counts[p] += freq
+                    where[p].add(i)
+            counts.pop(pair, None)
+        return cls(merges)
+
+    def encode_chunk(self, chunk):
+        ids = self.cache.get(chunk)
+        if ids is not None:
+            return ids
+        ids = list(chunk.encode('utf-8'))
+        while len(ids) >= 2:
+            # apply the earliest-learned merge present, exactly as training did
+            pair = min(zip(ids, ids[1:]), key=lambda p: self.ranks.get(p, len(self.ranks)))
+            if pair not in self.ranks:
+                break
+            ids = merge(ids, pair, 256 + self.ranks[pair])
+        if len(self.cache) >= cache_size:
+            self.cache.clear()
+        self.cache[chunk] = ids
+        return ids
+
+    def encode(self, text):
+        ids = []
+        for chunk in split_pattern.findall(text):
+            ids.extend(self.encode_chunk(chunk))
+        return ids
+
+    def decode(self, ids):
+        return b''.join(self.vocab[i] for i in ids).decode('utf-8', errors='replace')
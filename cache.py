@@ -0,0 +1,126 @@
+"""
+Small TTL + LRU cache for upstream responses, optionally kept in SQLite across restarts.
+
+    products = TTLCache('autosuggest', ttl=600, stale_ttl=3600, path='cache.db')
+    data = products.get_or_fetch(key, lambda: fetch(...))
+
+Entries younger than ttl are served as they are. Older entries still within
+stale_ttl are served straight away while one background thread fetches a new
+value (stale-while-revalidate). Anything older is fetched inline. Values must
+be JSON-serializable when a path is given.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ bounded LRU of key -> (stored_at, value) with hit/miss counters """
+
+    def __init__(self, name, maxsize=256, ttl=60, stale_ttl=0, path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.hits = self.stale_hits = self.misses = self.refresh_errors = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, stored_at REAL, value TEXT, "
+                            "PRIMARY KEY (name, key))")
+            self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _load(self, key):
+        # memory first, then the on-disk store
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        if self.db is None:
+            return None
+        row = self.db.execute("SELECT stored_at, value FROM cache WHERE name = ? AND key = ?",
+                              (self.name, json.dumps(key))).fetchone()
+        if row is None:
+            return None
+        entry = (row[0], json.loads(row[1]))
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, value):
+        entry = (time.time(), value)
+        with self.lock:
+            self._remember(key, entry)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                                (self.name, json.dumps(key), entry[0], json.dumps(value)))
+                # anything past its stale window can never be served again
+                self.db.execute("DELETE FROM cache WHERE name = ? AND stored_at < ?",
+                                (self.name, entry[0] - self.ttl - self.stale_ttl))
+                self.db.commit()
+
+    def invalidate(self, key=None):
+        # drop one key, or everything when key is None
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            if self.db is not None:
+                if key is None:
+                    self.db.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+                else:
+                    self.db.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, json.dumps(key)))
+                self.db.commit()
+
+    def get_or_fetch(self, key, fetch, allow_stale=True):
+        with self.lock:
+            entry = self._load(key)
+            age = time.time() - entry[0] if entry is not None else None
+            if entry is not None and age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if entry is not None and allow_stale and age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                if key not in self.refreshing:
+                    self.refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+                return entry[1]
+            self.misses += 1
+        # fetch outside the lock so a slow upstream doesn't block other keys
+        value = fetch()
+        self.put(key, value)
+        return value
+
+    def _refresh(self, key, fetch):
+        try:
+            self.put(key, fetch())
+        except Exception:
+            with self.lock:
+                self.refresh_errors += 1 # keep serving the stale value until it ages out
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self.entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refresh_errors': self.refresh_errors,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,66 @@
+"""
+Per-session shopping carts, kept in memory and written through to SQLite.
+
+    carts = CartStore('carts.db')
+    carts.add('alice', {'product_id': '123', 'item_id': 7, 'product_name': '...', 'quantity': 6})
+    carts.items('alice')
+
+Lines are keyed by product_id (item_id when there is none) within a session,
+so adding a product that is already in the cart merges the quantities in
+place. A session's cart is read from disk the first time it's used; without
+a path everything lives in an in-memory database.
+"""
+import json
+import sqlite3
+import threading
+
+
+class CartStore:
+    """ session -> {product_id: cart line}, safe to share between threads """
+
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cart_items (session TEXT, product_id TEXT, item TEXT, "
+                        "PRIMARY KEY (session, product_id))")
+        self.db.commit()
+        self.carts = {}
+        self.lock = threading.Lock()
+
+    def _cart(self, session):
+        cart = self.carts.get(session)
+        if cart is None:
+            rows = self.db.execute("SELECT product_id, item FROM cart_items WHERE session = ? ORDER BY rowid",
+                                   (session,))
+            cart = self.carts[session] = {key: json.loads(item) for key, item in rows}
+        return cart
+
+    def add(self, session, item):
+        key = str(item.get('product_id') or item.get('item_id'))
+        with self.lock:
+            cart = self._cart(session)
+            if key in cart:
+                item = {**cart[key], **item, 'quantity': cart[key]['quantity'] + item['quantity']}
+            cart[key] = item
+            # upsert keeps the row (and so the line's position in the cart) when quantities merge
+            self.db.execute("INSERT INTO cart_items VALUES (?, ?, ?) "
+                            "ON CONFLICT (session, product_id) DO UPDATE SET item = excluded.item",
+                            (session, key, json.dumps(item)))
+            self.db.commit()
+            return dict(item)
+
+    def remove(self, session, product_id):
+        key = str(product_id)
+        with self.lock:
+            self._cart(session).pop(key, None)
+            self.db.execute("DELETE FROM cart_items WHERE session = ? AND product_id = ?", (session, key))
+            self.db.commit()
+
+    def clear(self, session):
+        with self.lock:
+            self.carts[session] = {}
+            self.db.execute("DELETE FROM cart_items WHERE session = ?", (session,))
+            self.db.commit()
+
+    def items(self, session):
+        with self.lock:
+            return [dict(item) for item in self._cart(session).values()]
@@ -0,0 +1,152 @@
+"""
+Local fuzzy index over the wine catalogue, for resolving product names without a remote search.
+
+    index = CatalogIndex('catalog.jsonl')
+    index.add({'lwin': '1012361', 'name': 'Chateau Margaux 2015', 'url': '...'})
+    index.search('margaux chateau 2015')  # [(score, product), ...] best first
+
+Products are keyed by LWIN. Names (and producers when the data has them) are
+accent-folded and split into tokens, and every token into character trigrams
+that go into an inverted index (vintages get one too). A query is scored on
+how many of its trigrams and tokens a product shares, so word order, accents
+and small typos don't matter. A year in the query must match the vintage, and
+an LWIN in the query is an exact hit. The catalogue file is JSON lines, one
+product per line; products seen later are appended to it.
+"""
+import heapq
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+year_pattern = re.compile(r'(?:19|20)\d\d')
+min_coverage = 0.5 # share of the query's trigrams a product needs to be considered at all
+
+
+def normalize(text):
+    # strip accents, lowercase; Gemini+brave.py uses this for its cache keys too
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', text)
+        if unicodedata.category(c) != 'Mn'
+    ).lower().strip()
+
+
+def tokenize(text):
+    return re.findall(r'\w+', normalize(text))
+
+
+def name_within(query, product):
+    # every word of the product's name is in the query: scores reward covering the query, so
+    # "Dom Perignon Rose 2012" scores high for "dom perignon 2012" but doesn't pass this
+    return set(tokenize(product.get('name', ''))) <= set(tokenize(query))
+
+
+def trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class CatalogIndex:
+    """ trigram and vintage inverted indexes over product names, with LWIN lookup """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.products = {} # lwin -> product dict as we got it
+        self.vintages = {}
+        self.grams = {}    # lwin -> trigram set of its indexed text
+        self.tokens = {}
+        self.by_gram = defaultdict(set)
+        self.by_vintage = defaultdict(set)
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self._insert(json.loads(line))
+
+    def __len__(self):
+        return len(self.products)
+
+    def get(self, lwin):
+        return self.products.get(str(lwin))
+
+    def _insert(self, product):
+        # (re)index one product; returns False when nothing about it changed
+        lwin = str(product['lwin'])
+        if self.products.get(lwin) == product:
+            return False
+        self._remove(lwin)
+        tokens = set(tokenize(f"{product.get('name', '')} {product.get('producer') or ''}"))
+        vintage = str(product.get('vintage') or '')
+        if not year_pattern.fullmatch(vintage):
+            vintage = next((t for t in tokens if year_pattern.fullmatch(t)), None)
+        self.products[lwin] = product
+        self.vintages[lwin] = vintage
+        self.tokens[lwin] = tokens
+        self.grams[lwin] = set().union(*map(trigrams, tokens))
+        self.by_vintage[vintage].add(lwin)
+        for g in self.grams[lwin]:
+            self.by_gram[g].add(lwin)
+        return True
+
+    def _remove(self, lwin):
+        if lwin not in self.products:
+            return
+        for g in self.grams.pop(lwin):
+            self.by_gram[g].discard(lwin)
+        self.by_vintage[self.vintages.pop(lwin)].discard(lwin)
+        del self.products[lwin], self.tokens[lwin]
+
+    def add(self, products):
+        # index products as they are seen; new or changed ones are appended to the catalogue file
+        changed = []
+        with self.lock:
+            for product in products:
+                if product.get('lwin') and product.get('name') and self._insert(product):
+                    changed.append(product)
+            if changed and self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    for product in changed:
+                        f.write(json.dumps(product, ensure_ascii=False) + '\n')
+        return len(changed)
+
+    def search(self, query, limit=5, among=None):
+        # rank products against query, optionally only those whose lwin is in among
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+        with self.lock:
+            exact = [t for t in tokens if t in self.products and (among is None or t in among)]
+            if exact:
+                return [(1.0, self.products[lwin]) for lwin in exact[:limit]]
+
+            query_grams = set().union(*map(trigrams, tokens))
+            need = max(1, math.ceil(min_coverage * len(query_grams)))
+            years = {t for t in tokens if year_pattern.fullmatch(t)}
+            if among is not None:
+                pool = [lwin for lwin in among if lwin in self.products]
+            else:
+                # anything sharing `need` trigrams with the query shares one of its len - need + 1 rarest,
+                # so only those postings have to be read; a year narrows it down further, read whichever is shorter
+                rare = sorted(query_grams, key=lambda g: len(self.by_gram.get(g, ())))
+                postings = [self.by_gram.get(g, ()) for g in rare[:len(rare) - need + 1]]
+                if years and sum(map(len, postings)) > sum(len(self.by_vintage.get(y, ())) for y in years):
+                    postings = [self.by_vintage.get(y, ()) for y in years]
+                pool = set().union(*postings)
+
+            scored = []
+            for lwin in pool:
+                if years and self.vintages[lwin] not in years:
+                    continue
+                hits = len(query_grams & self.grams[lwin])
+                if hits < need:
+                    continue
+                # mostly how much of the query the name covers; the dice term prefers names without extra words
+                coverage = hits / len(query_grams)
+                dice = 2 * hits / (len(query_grams) + len(self.grams[lwin]))
+                score = 0.6 * coverage + 0.25 * len(tokens & self.tokens[lwin]) / len(tokens) + 0.15 * dice
+                scored.append((score, lwin))
+            return [(round(score, 4), self.products[lwin]) for score, lwin in heapq.nlargest(limit, scored)]
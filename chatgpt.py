@@ -1,12 +1,26 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from google.colab import files
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+import argparse
+import contextlib
 import io
+import json
 import os
-print(os.listdir('/content'))
-
-uploaded = files.upload()
+import queue
+import resource
+import socket
+import threading
+import time
+import numpy as np
+from prepare import prepare, load_tokens
+from bpe import Tokenizer
+try:
+    from google.colab import files # only available when running in Colab
+except ImportError:
+    files = None
 
   # hyperparameters
 batch_size = 32 # how many independent sequences will we process in parallel
@@ -16,93 +30,279 @@ eval_interval = 500
 learning_rate = 1e-3
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 eval_iters = 200
+eval_full = ['val'] # splits scored with one deterministic pass over every token instead of eval_iters random batches
+eval_batch_size = 512 # windows per forward pass in a full-pass evaluation
 n_embd = 32
+n_head = 4
+text_shards = ['input.txt'] # text files that make up the training corpus
+token_path = 'input.bin' # pre-tokenized corpus written by prepare.py
+tokenizer = 'char' # 'char' for one token per character, 'bpe' for byte-pair merges learned by bpe.py
+bpe_vocab_size = 512 # vocabulary size to learn when tokenizer = 'bpe'
+prefetch = 2 # training batches sampled ahead on a background thread (0 to sample inline)
+pin_memory = device == 'cuda' # stage batches in page-locked memory for async host-to-device copies
+data_seed = None # seed the batch sampler independently of the global RNG for reproducible batches
+checkpoint_path = 'ckpt.pt'
+checkpoint_interval = 1000 # steps between checkpoints, written on a background thread
+config_keys = ['block_size', 'n_embd', 'n_head'] # hyperparameters that shape the model, saved with checkpoints
+ddp_backend = 'gloo' # torch.distributed backend for data-parallel training on CPU
+log_path = None # append per-phase timings, tokens/sec and memory peaks as JSON lines every eval_interval steps
+profile_steps = None # (first, last) training steps to capture with torch.profiler
+profile_path = 'trace.json' # chrome trace written when the profiler window closes
+amp_dtype = None # torch.bfloat16 runs the training forward pass under autocast (bf16 needs no loss scaling)
+compile_model = False # torch.compile the training step, falling back to eager if compilation fails
 
   # ------------
 
 torch.manual_seed(1337)
 
-  # Access the uploaded file using its key 'winemag-data.csv'
-  # text = io.BytesIO(uploaded['winemag-data.csv']).read().decode('utf-8')
-with open('input.txt', 'r', encoding='utf-8') as f:
-    text = f.read()
+  # data-parallel training: one process per worker, set up by setup_distributed()
+ddp_rank = 0
+ddp_local_rank = 0
+ddp_world_size = 1
+master_process = True # only this process logs, evaluates and writes checkpoints
+
+def setup_distributed():
+    # WORLD_SIZE and friends come from torchrun (multi-node) or from spawn_workers() (one node)
+    global ddp_rank, ddp_local_rank, ddp_world_size, master_process, batch_size
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1:
+        return
+    dist.init_process_group(backend=ddp_backend)
+    ddp_rank = dist.get_rank()
+    ddp_local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    ddp_world_size = dist.get_world_size()
+    master_process = ddp_rank == 0
+    # split the global batch so training matches a single process at the same batch_size
+    if batch_size % ddp_world_size:
+        raise ValueError(f"batch_size {batch_size} does not split evenly over {ddp_world_size} workers")
+    batch_size //= ddp_world_size
+    # share the node's cores between the workers running on it
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', 1))))
 
-  # here are all the unique characters that occur in this text
-chars = sorted(list(set(text)))
-vocab_size = len(chars)
   # create a mapping from characters to integers
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
-encode = lambda s: [stoi[c] for c in s] # encoder: take a string, output a list of integers
-decode = lambda l: ''.join([itos[i] for i in l]) # decoder: take a list of integers, output a string
-
-  # Train and test splits
-data = torch.tensor(encode(text), dtype=torch.long)
-n = int(0.9*len(data)) # first 90% will be train, rest val
-train_data = data[:n]
-val_data = data[n:]
+vocab = {} # tokenizer description from the token store, saved with checkpoints
+stoi = {}
+itos = {}
+bpe_tokenizer = None # bpe.Tokenizer when the vocabulary is byte-pair merges
+encode = lambda s: bpe_tokenizer.encode(s) if bpe_tokenizer else [stoi[c] for c in s] # encoder: take a string, output a list of integers
+decode = lambda l: bpe_tokenizer.decode(l) if bpe_tokenizer else ''.join([itos[i] for i in l]) # decoder: take a list of integers, output a string
+token_bytes = lambda i: bpe_tokenizer.vocab[i] if bpe_tokenizer else itos[i].encode('utf-8') # utf-8 bytes of one token, for streaming
+
+def set_vocab(v):
+    global vocab, vocab_size, stoi, itos, bpe_tokenizer
+    vocab = v
+    if v['tokenizer'] == 'bpe':
+        bpe_tokenizer = Tokenizer(v['merges'])
+        vocab_size = bpe_tokenizer.vocab_size
+        stoi, itos = {}, {}
+    else:
+        bpe_tokenizer = None
+        vocab_size = len(v['chars'])
+        stoi = { ch:i for i,ch in enumerate(v['chars']) }
+        itos = { i:ch for i,ch in enumerate(v['chars']) }
+
+def encode_prompt(prompt):
+    # an empty prompt starts from a newline (token 0 of the character vocabulary)
+    if prompt:
+        return encode(prompt)
+    return encode('\n') if bpe_tokenizer else [0]
+
+def token_store_stale():
+    if not os.path.exists(token_path) or any(os.path.getmtime(p) > os.path.getmtime(token_path) for p in text_shards):
+        return True
+    # rebuild when the configured tokenizer no longer matches the one the store was written with
+    _, meta = load_tokens(token_path)
+    return meta.get('tokenizer', 'char') != tokenizer or (tokenizer == 'bpe' and meta['vocab_size'] != bpe_vocab_size)
+
+def load_data():
+    global train_data, val_data
+    if files is not None and not all(os.path.exists(p) for p in text_shards):
+        files.upload() # in Colab, upload the corpus first
+      # Access the uploaded file using its key 'winemag-data.csv'
+      # text = io.BytesIO(uploaded['winemag-data.csv']).read().decode('utf-8')
+      # tokenize the corpus once into a compact token file, then memory-map it
+    if ddp_local_rank == 0 and token_store_stale():
+        prepare(text_shards, token_path, tokenizer, bpe_vocab_size)
+    if ddp_world_size > 1:
+        dist.barrier() # wait for each node's first worker to write the token file
+    data, meta = load_tokens(token_path)
+
+      # here are all the unique characters (or byte-pair merges) that occur in this text
+    set_vocab({k: meta[k] for k in ('chars', 'merges') if k in meta} | {'tokenizer': meta.get('tokenizer', 'char')})
+
+      # Train and test splits
+    n = int(0.9*len(data)) # first 90% will be train, rest val
+    train_data = data[:n]
+    val_data = data[n:]
 
   # data loading
+class BatchSampler:
+    """ draws random (x, y) windows from a token array, optionally prefetching on a background thread """
+
+    def __init__(self, data, batch_size, block_size, seed=None, pin_memory=False, prefetch=0):
+        self.data = data
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.pin_memory = pin_memory
+        self.offsets = np.arange(block_size + 1) # x and y share one window of block_size+1 tokens
+        # the background thread can't share the global RNG with the training loop without
+        # making batch order depend on thread timing, so it always gets its own generator
+        self.generator = None
+        if seed is not None or prefetch:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(seed if seed is not None else int(torch.randint(2**62, (1,))))
+        self.queue = None
+        if prefetch:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._fill, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        # one gather over all batch_size windows instead of a python loop of slices
+        ix = torch.randint(len(self.data) - self.block_size, (self.batch_size,), generator=self.generator)
+        windows = torch.from_numpy(self.data[ix.numpy()[:, None] + self.offsets].astype(np.int64)) # (B, block_size+1)
+        x = windows[:, :-1].contiguous()
+        y = windows[:, 1:].contiguous()
+        if self.pin_memory:
+            x, y = x.pin_memory(), y.pin_memory()
+        return x, y
+
+    def _fill(self):
+        while not self.stopped.is_set():
+            try:
+                batch = self.sample()
+            except Exception as e:
+                batch = e
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def next(self, device):
+        if self.queue is None:
+            batch = self.sample()
+        else:
+            batch = self.queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+        x, y = batch
+        return x.to(device, non_blocking=self.pin_memory), y.to(device, non_blocking=self.pin_memory)
+
+    def close(self):
+        if self.queue is not None:
+            self.stopped.set()
+            self.thread.join()
+
+samplers = {}
+
+def init_samplers():
+    # every data-parallel worker draws its own batches
+    seed = None if data_seed is None else data_seed + 1000 * ddp_rank
+    samplers['train'] = BatchSampler(train_data, batch_size, block_size, seed=seed, pin_memory=pin_memory, prefetch=prefetch)
+    samplers['val'] = BatchSampler(val_data, batch_size, block_size, seed=None if data_seed is None else data_seed + 1, pin_memory=pin_memory)
+
 def get_batch(split):
       # generate a small batch of data of inputs x and targets y
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([data[i:i+block_size] for i in ix])
-    y = torch.stack([data[i+1:i+block_size+1] for i in ix])
-    x, y = x.to(device), y.to(device)
-    return x, y
+    return samplers[split].next(device)
+
+@torch.no_grad()
+def evaluate(data):
+    # score every target of a split once: non-overlapping block_size windows in large batches,
+    # with the loss summed on the device so there is a single sync at the end
+    t0 = time.time()
+    n_targets = len(data) - 1
+    offsets = np.arange(block_size + 1)
+    starts = np.arange(0, n_targets - block_size + 1, block_size)
+    total = torch.zeros((), device=device)
+    for b in range(0, len(starts), eval_batch_size):
+        windows = torch.from_numpy(data[starts[b:b+eval_batch_size, None] + offsets].astype(np.int64)).to(device)
+        logits, _ = model(windows[:, :-1])
+        total += F.cross_entropy(logits.flatten(0, 1), windows[:, 1:].flatten(), reduction='sum')
+    # the last few targets don't fill a window: score them at the end of one window that does
+    tail = n_targets - len(starts) * block_size
+    if tail:
+        window = torch.from_numpy(data[n_targets - block_size:].astype(np.int64)).to(device)[None]
+        logits, _ = model(window[:, :-1])
+        total += F.cross_entropy(logits[0, -tail:], window[0, -tail:], reduction='sum')
+    loss = total.item() / n_targets
+    return loss, n_targets / (time.time() - t0)
 
 @torch.no_grad()
 def estimate_loss():
     out = {}
     model.eval()
     for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
+        if split in eval_full:
+            out[split], out[split + '_tokens_per_sec'] = evaluate(train_data if split == 'train' else val_data)
+            continue
+        losses = torch.zeros(eval_iters, device=device)
         for k in range(eval_iters):
               X, Y = get_batch(split)
               logits, loss = model(X, Y)
-              losses[k] = loss.item()
-        out[split] = losses.mean()
-        model.train()
-        return out
+              losses[k] = loss
+        out[split] = losses.mean().item()
+    model.train()
+    return out
 
-class Head(nn.Module):
-      """ one head of self-attention """
-
-      def __init__(self, head_size):
-          super().__init__()
-          self.key = nn.Linear(n_embd, head_size, bias=False)
-          self.query = nn.Linear(n_embd, head_size, bias=False)
-          self.value = nn.Linear(n_embd, head_size, bias=False)
-          self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
-
-
-
-      def forward(self, x):
-          # input of size (batch, time-step, channels)
-          # output of size (batch, time-step, head size)
-          B,T,C = x.shape
-          k = self.key(x)   # (B,T,hs)
-          q = self.query(x) # (B,T,hs)
-          # compute attention scores ("affinities")
-          wei = q @ k.transpose(-2,-1) * C**-0.5 # (B, T, hs) @ (B, hs, T) -> (B, T, T)
-          wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B, T, T)
-          wei = F.softmax(wei, dim=-1) # (B, T, T)
-
-          # perform the weighted aggregation of the values
-          v = self.value(x) # (B,T,hs)
-          out = wei @ v # (B, T, T) @ (B, T, hs) -> (B, T, hs)
-          return out
-      
 class MultiHeadAttention(nn.Module):
-      """ multiple heads of self-attention in parallel """
+      """ multiple heads of causal self-attention, fused into batched matmuls """
 
       def __init__(self, num_heads, head_size):
           super().__init__()
-          self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
-
-      def forward(self, x):
-          return torch.cat([h(x) for h in self.heads], dim=-1)
+          self.num_heads = num_heads
+          self.head_size = head_size
+          # one projection produces the queries, keys and values of every head at once
+          self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+          # key/value cache for incremental decoding, allocated by init_cache()
+          self.k_cache = None
+          self.v_cache = None
+
+      def init_cache(self, batch_size, device):
+          # preallocate room for one full context window of keys and values
+          # (qkv may be an int8 module without a float weight, so dtype isn't taken from it)
+          shape = (batch_size, self.num_heads, block_size, self.head_size)
+          self.k_cache = torch.zeros(shape, dtype=torch.float32, device=device)
+          self.v_cache = torch.zeros(shape, dtype=torch.float32, device=device)
+
+      def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+          # checkpoints from the per-Head implementation hold separate key/query/value
+          # weights (and a tril buffer) for every head: stack them into the fused projection
+          if prefix + 'qkv.weight' not in state_dict and prefix + 'heads.0.key.weight' in state_dict:
+              weights = []
+              for name in ('query', 'key', 'value'):
+                  weights += [state_dict.pop(f'{prefix}heads.{i}.{name}.weight') for i in range(self.num_heads)]
+              state_dict[prefix + 'qkv.weight'] = torch.cat(weights)
+              for i in range(self.num_heads):
+                  state_dict.pop(f'{prefix}heads.{i}.tril', None)
+          super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+      def forward(self, x, start_pos=None):
+          # input of size (batch, time-step, channels)
+          # output of size (batch, time-step, num_heads * head size)
+          # with start_pos set, x holds positions start_pos..start_pos+T-1 and attends over the cache
+          B,T,C = x.shape
+          q, k, v = self.qkv(x).split(self.num_heads * self.head_size, dim=-1)
+          q = q.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B,nh,T,hs)
+          k = k.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B,nh,T,hs)
+          v = v.view(B, T, self.num_heads, self.head_size).transpose(1, 2) # (B,nh,T,hs)
+          p = 0
+          if start_pos is not None:
+              p = start_pos
+              self.k_cache[:B, :, p:p+T] = k
+              self.v_cache[:B, :, p:p+T] = v
+              k = self.k_cache[:B, :, :p+T] # (B,nh,p+T,hs)
+              v = self.v_cache[:B, :, :p+T] # (B,nh,p+T,hs)
+          # is_causal aligns the mask to the top-left corner, which is only right when
+          # nothing is cached ahead of the queries; a single new token may see everything
+          mask = None
+          if p > 0 and T > 1:
+              mask = torch.ones(T, p+T, dtype=torch.bool, device=x.device).tril(diagonal=p)
+          # scores are scaled by the embedding width, as the per-head modules always did
+          out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                               is_causal=mask is None and T > 1, scale=C**-0.5) # (B,nh,T,hs)
+          return out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
 
 
   # super simple bigram model
@@ -113,16 +313,17 @@ class BigramLanguageModel(nn.Module):
           # each token directly reads off the logits for the next token from a lookup table
           self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
           self.position_embedding_table = nn.Embedding(block_size, n_embd)
-          self.sa_heads =MultiHeadAttention(4, n_embd//4)
+          self.sa_heads =MultiHeadAttention(n_head, n_embd//n_head)
           self.lm_head = nn.Linear(n_embd, vocab_size)
 
-      def forward(self, idx, targets=None):
+      def forward(self, idx, targets=None, start_pos=None):
           B,T = idx.shape
+          p = 0 if start_pos is None else start_pos
 
           token_embeddings = self.token_embedding_table(idx) # (B,T,C)
-          position_embeddings = self.position_embedding_table(torch.arange(T, device=device)) # (T,C)
-          x = token_embeddings + position_embeddings
-          x= self.sa_heads(x)
+          position_embeddings = self.position_embedding_table(torch.arange(p, p+T, device=device)) # (T,C)
+          x = (token_embeddings + position_embeddings).float() # embeddings may be kept in reduced precision for inference
+          x= self.sa_heads(x, start_pos)
           logits = self.lm_head(x) # (B,T,vocab_size)
 
           if targets is None:
@@ -135,44 +336,506 @@ class BigramLanguageModel(nn.Module):
 
           return logits, loss
 
-      def generate(self, idx, max_new_tokens):
+      @torch.no_grad()
+      def generate(self, idx, max_new_tokens, use_cache=True):
           # idx is (B, T) array of indices in the current context
-          for _ in range(max_new_tokens):
-              idx_cond= idx[:, -block_size:]
-              # get the predictions
-              logits, loss = self(idx_cond)
-              # focus only on the last time step
-              logits = logits[:, -1, :] # becomes (B, C)
-              # apply softmax to get probabilities
-              probs = F.softmax(logits, dim=-1) # (B, C)
-              # sample from the distribution
-              idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
-              # append sampled index to the running sequence
-              idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
-          return idx
-
-model = BigramLanguageModel(vocab_size)
-m = model.to(device)
-
-  # create a PyTorch optimizer
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
-
-for iter in range(max_iters):
-
-      # every once in a while evaluate the loss on train and val sets
-      if iter % eval_interval == 0:
-          losses = estimate_loss()
-          print(f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-
-      # sample a batch of data
-      xb, yb = get_batch('train')
-
-      # evaluate the loss
-      logits, loss = model(xb, yb)
-      optimizer.zero_grad(set_to_none=True)
-      loss.backward()
-      optimizer.step()
-
-  # generate from the model
-context = torch.zeros((1, 1), dtype=torch.long, device=device)
-print(decode(m.generate(context, max_new_tokens=500)[0].tolist()))
\ No newline at end of file
+          if not use_cache:
+              for _ in range(max_new_tokens):
+                  idx_cond= idx[:, -block_size:]
+                  # get the predictions
+                  logits, loss = self(idx_cond)
+                  # focus only on the last time step
+                  logits = logits[:, -1, :] # becomes (B, C)
+                  # apply softmax to get probabilities
+                  probs = F.softmax(logits, dim=-1) # (B, C)
+                  # sample from the distribution
+                  idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
+                  # append sampled index to the running sequence
+                  idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
+              return idx
+
+          # incremental decoding: write into a preallocated output instead of growing idx,
+          # and only run the newest token through the model while the window has room
+          B, T = idx.shape
+          out = torch.empty((B, T + max_new_tokens), dtype=idx.dtype, device=idx.device)
+          out[:, :T] = idx
+          self.sa_heads.init_cache(B, idx.device)
+          n = min(T, block_size) # number of positions currently in the cache
+          logits, _ = self(out[:, T-n:T], start_pos=0) # prefill with the (cropped) prompt
+          for t in range(T, T + max_new_tokens):
+              probs = F.softmax(logits[:, -1, :], dim=-1) # (B, C)
+              out[:, t:t+1] = torch.multinomial(probs, num_samples=1) # (B, 1)
+              if t + 1 == T + max_new_tokens:
+                  break
+              if n < block_size:
+                  logits, _ = self(out[:, t:t+1], start_pos=n)
+                  n += 1
+              else:
+                  # the window slides by one, which shifts every position embedding,
+                  # so the cached keys/values are stale: refill from the cropped window
+                  logits, _ = self(out[:, t+1-block_size:t+1], start_pos=0)
+          return out
+
+      @torch.no_grad()
+      def next_probs(self, contexts):
+          # next-token distribution after each context (a list of token lists), in one forward pass:
+          # every context is cropped to the window generate() would use, left-aligned and
+          # right-padded, and read out at its last real position
+          window = self.position_embedding_table.num_embeddings
+          rows = [torch.tensor(c[-window:]) for c in contexts]
+          lengths = torch.tensor([len(r) for r in rows])
+          idx = nn.utils.rnn.pad_sequence(rows, batch_first=True).to(device)
+          logits, _ = self(idx)
+          return F.softmax(logits[torch.arange(len(rows)), lengths - 1].float(), dim=-1) # (len(contexts), C)
+
+      @torch.no_grad()
+      def generate_speculative(self, idx, max_new_tokens, draft, k=4):
+          # speculative sampling: the draft proposes k tokens, one batched forward pass of this model
+          # scores all of them, and accept/reject keeps the output distributed exactly as generate()
+          assert idx.shape[0] == 1, "speculative decoding samples one sequence at a time"
+          tokens = idx[0].tolist()
+          T = len(tokens)
+          stats = {'proposed': 0, 'accepted': 0, 'target_passes': 0}
+          while len(tokens) - T < max_new_tokens:
+              n = min(k, max_new_tokens - (len(tokens) - T))
+              proposal, q = draft.propose(tokens, n) # q[i] is the draft distribution proposal[i] was drawn from
+              p = self.next_probs([tokens + proposal[:i] for i in range(n + 1)]) # (n+1, C)
+              stats['proposed'] += n
+              stats['target_passes'] += 1
+              for i, x in enumerate(proposal):
+                  if torch.rand(()) < p[i, x] / q[i, x]:
+                      tokens.append(x)
+                      stats['accepted'] += 1
+                      continue
+                  # rejected: resample from the part of p that q under-covers
+                  residual = (p[i] - q[i]).clamp(min=0)
+                  tokens.append(torch.multinomial(residual if residual.sum() > 0 else p[i], 1).item())
+                  break
+              else:
+                  if len(tokens) - T < max_new_tokens:
+                      tokens.append(torch.multinomial(p[n], 1).item()) # every draft accepted: one bonus token
+          stats['acceptance_rate'] = stats['accepted'] / max(stats['proposed'], 1)
+          stats['tokens_per_pass'] = max_new_tokens / max(stats['target_passes'], 1)
+          return torch.tensor([tokens], dtype=idx.dtype, device=idx.device), stats
+
+  # checkpoints
+def clone_state(obj):
+    # copy every tensor so training can keep updating the originals while a snapshot is saved
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: clone_state(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_state(v) for v in obj)
+    return obj
+
+def write_checkpoint(checkpoint, path):
+    # write to a temporary file first so a crash mid-save never leaves a truncated checkpoint
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+saver = None
+
+def save_checkpoint(step, path=None, wait=False):
+    # snapshot on the training thread (a memcpy), serialize on a background thread
+    global saver
+    path = path or checkpoint_path
+    checkpoint = {
+        'model': clone_state(model.state_dict()),
+        'optimizer': clone_state(optimizer.state_dict()),
+        'step': step,
+        'config': {k: globals()[k] for k in config_keys},
+        'vocab': vocab,
+    }
+    if saver is not None:
+        saver.join() # at most one save in flight
+    saver = threading.Thread(target=write_checkpoint, args=(checkpoint, path))
+    saver.start()
+    if wait:
+        saver.join()
+
+def load_checkpoint(path=None):
+    global model
+    checkpoint = torch.load(path or checkpoint_path, map_location=device)
+    globals().update(checkpoint['config']) # the model is built from the module-level hyperparameters
+    # checkpoints from before the tokenizer option only stored the character list
+    set_vocab(checkpoint.get('vocab') or {'tokenizer': 'char', 'chars': checkpoint['chars']})
+    model = BigramLanguageModel(vocab_size).to(device)
+    model.load_state_dict(checkpoint['model'])
+    return checkpoint
+
+  # instrumentation
+class PhaseTimer:
+    """ wall-clock samples of each training loop phase, summarized into histograms """
+
+    buckets_ms = [0.1 * 2**i for i in range(16)] # histogram upper edges: 0.1ms .. ~3.3s
+
+    def __init__(self, enabled=True):
+        self.times = {}
+        self.enabled = enabled # only the master process summarizes (and so clears) the samples
+        self.profiling = False # also label phases in a running torch.profiler trace
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        with torch.profiler.record_function(name) if self.profiling else contextlib.nullcontext():
+            t0 = time.perf_counter()
+            yield
+            if device == 'cuda':
+                torch.cuda.synchronize() # time the kernels, not just their launch
+            self.times.setdefault(name, []).append(time.perf_counter() - t0)
+
+    def summary(self):
+        # per phase: totals, percentiles and counts per histogram bucket since the last reset
+        out = {}
+        for name, times in self.times.items():
+            ms = np.array(times) * 1000
+            counts = np.bincount(np.searchsorted(self.buckets_ms, ms), minlength=len(self.buckets_ms) + 1)
+            out[name] = {
+                'count': len(ms),
+                'total_ms': float(ms.sum()),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p90_ms': float(np.percentile(ms, 90)),
+                'p99_ms': float(np.percentile(ms, 99)),
+                'max_ms': float(ms.max()),
+                'histogram': {f'<={edge:g}ms': int(c) for edge, c in zip(self.buckets_ms, counts) if c}
+                             | ({'inf': int(counts[-1])} if counts[-1] else {}),
+            }
+        self.times = {}
+        return out
+
+def memory_peaks():
+    peaks = {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024} # KiB on Linux
+    if device == 'cuda':
+        peaks['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    return peaks
+
+def log_step(record):
+    with open(log_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+  # fast training step
+def autocast():
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    if amp_dtype != torch.bfloat16:
+        raise ValueError("only bfloat16 autocast is supported; float16 would need a gradient scaler")
+    return torch.autocast(device_type='cuda' if device == 'cuda' else 'cpu', dtype=amp_dtype)
+
+def setup_fast_path(train_model, xb, yb):
+    # run one batch through the eager fp32, eager autocast and compiled steps, report their losses and
+    # the compile time, and only keep the compiled step if it compiles and matches eager
+    def probe(m, amp):
+        with autocast() if amp else contextlib.nullcontext():
+            _, loss = m(xb, yb)
+        loss.backward()
+        for p in model.parameters():
+            p.grad = None
+        return loss.item()
+
+    report = {'fp32_loss': probe(train_model, amp=False)}
+    if amp_dtype is not None:
+        report['amp_loss'] = probe(train_model, amp=True)
+    eager_loss = report.get('amp_loss', report['fp32_loss'])
+    if compile_model:
+        try:
+            compiled = torch.compile(train_model)
+            t0 = time.time()
+            report['compiled_loss'] = probe(compiled, amp=amp_dtype is not None) # the first call compiles forward and backward
+            report['compile_s'] = time.time() - t0
+        except Exception as e:
+            report['compile_error'] = f"{type(e).__name__}: {str(e).strip().splitlines()[0] if str(e).strip() else ''}"
+        else:
+            # bf16 rounding differs between fused and unfused kernels, so allow more slack under autocast
+            tolerance = 2e-2 if amp_dtype is not None else 1e-4
+            if abs(report['compiled_loss'] - eager_loss) <= tolerance * abs(eager_loss):
+                train_model = compiled
+            else:
+                report['compile_error'] = "compiled loss does not match eager"
+    if master_process:
+        print("fast path: " + ", ".join(f"{k} {v:.6f}" if isinstance(v, float) else f"{k} {v}" for k, v in report.items())
+              + (", training eagerly" if 'compile_error' in report else ''))
+        if log_path:
+            log_step({'fast_path': report})
+    return train_model
+
+def train(resume=False):
+    global model, optimizer
+    setup_distributed()
+    load_data()
+    start = 0
+    if resume and os.path.exists(checkpoint_path):
+        data_vocab = vocab
+        checkpoint = load_checkpoint(checkpoint_path)
+        if vocab != data_vocab:
+            raise ValueError(f"{checkpoint_path} was trained on a different vocabulary than {token_path}")
+        start = checkpoint['step']
+        if master_process:
+            print(f"resuming from {checkpoint_path} at step {start}")
+    else:
+        checkpoint = None
+        model = BigramLanguageModel(vocab_size).to(device)
+    train_model = model
+    if ddp_world_size > 1:
+        # DDP broadcasts rank 0's weights and averages gradients across workers in backward()
+        train_model = DDP(model)
+        if data_seed is None:
+            torch.manual_seed(1337 + ddp_rank) # the model is built, so this only changes which batches are drawn
+    init_samplers()
+    if amp_dtype is not None or compile_model:
+        train_model = setup_fast_path(train_model, *get_batch('train'))
+
+      # create a PyTorch optimizer
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+    if checkpoint is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+    tokens_per_iter = batch_size * block_size * ddp_world_size
+    timer = PhaseTimer(enabled=master_process)
+    profiler = None
+    t0, t0_iter = time.time(), start
+    for iter in range(start, max_iters):
+
+          if profile_steps and iter == profile_steps[0] and master_process:
+              activities = [torch.profiler.ProfilerActivity.CPU]
+              if device == 'cuda':
+                  activities.append(torch.profiler.ProfilerActivity.CUDA)
+              profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+              profiler.start()
+              timer.profiling = True
+
+          # every once in a while evaluate the loss on train and val sets
+          if iter % eval_interval == 0 and master_process:
+              train_time = time.time() - t0
+              with timer.phase('estimate_loss'):
+                  losses = estimate_loss()
+              tokens_per_sec = (iter - t0_iter) * tokens_per_iter / train_time if iter > t0_iter else None
+              print(f"step {iter}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}"
+                    + ''.join(f", {split} eval {losses[split + '_tokens_per_sec']:,.0f} tok/s" for split in eval_full)
+                    + (f", train {tokens_per_sec:,.0f} tok/s" if tokens_per_sec else ''))
+              if log_path:
+                  log_step({'step': iter, 'time': time.time(), **losses, 'train_tokens_per_sec': tokens_per_sec,
+                            **memory_peaks(), 'phases': timer.summary()})
+              else:
+                  timer.summary()
+              t0, t0_iter = time.time(), iter
+
+          # sample a batch of data
+          with timer.phase('get_batch'):
+              xb, yb = get_batch('train')
+
+          # evaluate the loss
+          with timer.phase('forward'), autocast():
+              logits, loss = train_model(xb, yb)
+          with timer.phase('backward'):
+              optimizer.zero_grad(set_to_none=True)
+              loss.backward()
+          with timer.phase('optimizer'):
+              optimizer.step()
+
+          if profiler is not None and iter == profile_steps[1]:
+              profiler.stop()
+              profiler.export_chrome_trace(profile_path)
+              print(f"wrote torch.profiler trace of steps {profile_steps[0]}..{iter} to {profile_path}")
+              profiler = None
+              timer.profiling = False
+
+          if (iter + 1) % checkpoint_interval == 0 and master_process:
+              save_checkpoint(iter + 1)
+    samplers['train'].close()
+    if master_process:
+        save_checkpoint(max_iters, wait=True)
+    if ddp_world_size > 1:
+        dist.destroy_process_group()
+
+def worker(local_rank, nproc, resume, overrides):
+    os.environ.update(RANK=str(local_rank), LOCAL_RANK=str(local_rank),
+                      WORLD_SIZE=str(nproc), LOCAL_WORLD_SIZE=str(nproc))
+    globals().update(overrides) # spawned processes re-import the module, so command-line settings are passed along
+    train(resume)
+
+def spawn_workers(nproc, resume=False):
+    # single-node data parallelism; for several nodes launch `torchrun ... chatgpt.py train` instead
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    overrides = {k: globals()[k] for k in ('checkpoint_path', 'log_path', 'profile_steps', 'profile_path', 'amp_dtype', 'compile_model')}
+    mp.spawn(worker, args=(nproc, resume, overrides), nprocs=nproc)
+
+  # quantized inference
+def quantize(model, embeddings_dtype=None):
+    # int8 weights for every linear layer (qkv and lm_head), activations quantized on the fly;
+    # returns a copy and only runs on CPU
+    if device != 'cpu':
+        raise ValueError("dynamic int8 quantization is only supported on CPU")
+    qmodel = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if embeddings_dtype is not None:
+        qmodel.token_embedding_table.to(embeddings_dtype)
+        qmodel.position_embedding_table.to(embeddings_dtype)
+    return qmodel.eval()
+
+def model_bytes(m):
+    buffer = io.BytesIO()
+    torch.save(m.state_dict(), buffer)
+    return buffer.tell()
+
+@torch.no_grad()
+def quantization_report(path=None, embeddings_dtype=None, gen_tokens=500):
+    # compare the fp32 checkpoint against its int8 version: val loss, size and generation speed
+    global model
+    load_checkpoint(path)
+    checkpoint_vocab = vocab
+    load_data()
+    if vocab != checkpoint_vocab:
+        raise ValueError(f"{path or checkpoint_path} was trained on a different vocabulary than {token_path}")
+    fp32 = model.eval()
+    report = {}
+    for name, m in (('fp32', fp32), ('int8', quantize(fp32, embeddings_dtype))):
+        model = m
+        val_loss, eval_tokens_per_sec = evaluate(val_data)
+        context = torch.tensor([encode_prompt('')], dtype=torch.long, device=device)
+        t0 = time.time()
+        m.generate(context, max_new_tokens=gen_tokens)
+        report[name] = {
+            'val_loss': val_loss,
+            'eval_tokens_per_sec': eval_tokens_per_sec,
+            'generate_tokens_per_sec': gen_tokens / (time.time() - t0),
+            'size_mb': model_bytes(m) / 2**20,
+        }
+    model = fp32
+    report['val_loss_delta'] = report['int8']['val_loss'] - report['fp32']['val_loss']
+    return report
+
+  # speculative decoding
+class Draft:
+    """ cheap proposal model for generate_speculative(); subclasses give next_probs(contexts) """
+
+    def propose(self, tokens, k):
+        # sample k tokens one after another, keeping the distribution each was drawn from
+        proposal, q = [], []
+        for _ in range(k):
+            probs = self.next_probs([tokens + proposal])[0]
+            proposal.append(torch.multinomial(probs, 1).item())
+            q.append(probs)
+        return proposal, torch.stack(q)
+
+class BigramDraft(Draft):
+    """ next-token frequencies given only the previous token, counted over the training split """
+
+    def __init__(self, data, vocab_size):
+        if vocab_size > 4096:
+            raise ValueError(f"a {vocab_size}x{vocab_size} bigram table is too large; use a draft checkpoint")
+        data = data.astype(np.int64)
+        counts = np.bincount(data[:-1] * vocab_size + data[1:], minlength=vocab_size * vocab_size)
+        counts = torch.tensor(counts.reshape(vocab_size, vocab_size), dtype=torch.float32) + 1 # add-one smoothing
+        self.probs = (counts / counts.sum(dim=-1, keepdim=True)).to(device)
+
+    def next_probs(self, contexts):
+        return self.probs[[c[-1] for c in contexts]]
+
+class ModelDraft(Draft):
+    """ a smaller BigramLanguageModel trained on the same vocabulary """
+
+    def __init__(self, model):
+        self.model = model.eval()
+
+    def next_probs(self, contexts):
+        return self.model.next_probs(contexts)
+
+def load_draft(spec):
+    # 'bigram' counts a table from the token store; anything else is a (smaller) checkpoint
+    model_vocab = vocab
+    if spec == 'bigram':
+        load_data()
+        draft = BigramDraft(train_data, vocab_size)
+        draft_vocab = vocab
+    else:
+        checkpoint = torch.load(spec, map_location=device)
+        draft_vocab = checkpoint.get('vocab') or {'tokenizer': 'char', 'chars': checkpoint['chars']}
+        # build with the draft's own shape, then put the target model's hyperparameters back
+        saved = {k: globals()[k] for k in checkpoint['config']}
+        globals().update(checkpoint['config'])
+        try:
+            draft_model = BigramLanguageModel(vocab_size).to(device)
+        finally:
+            globals().update(saved)
+        draft_model.load_state_dict(checkpoint['model'])
+        draft = ModelDraft(draft_model)
+    if draft_vocab != model_vocab:
+        raise ValueError(f"draft {spec} does not share the model's vocabulary")
+    set_vocab(model_vocab)
+    return draft
+
+def sample(prompt='', max_new_tokens=500, path=None, int8=False, embeddings_dtype=None, draft=None, k=4):
+    # inference only needs the checkpoint: no corpus, tokenizer pass or optimizer
+    global model
+    path = path or checkpoint_path
+    t0 = time.time()
+    load_checkpoint(path)
+    model.eval()
+    if int8:
+        model = quantize(model, embeddings_dtype)
+    print(f"loaded {path} in {time.time() - t0:.2f}s")
+    context = torch.tensor([encode_prompt(prompt)], dtype=torch.long, device=device)
+    if draft is None:
+        return decode(model.generate(context, max_new_tokens=max_new_tokens)[0].tolist())
+
+    draft = load_draft(draft)
+    t0 = time.time()
+    out, stats = model.generate_speculative(context, max_new_tokens, draft, k=k)
+    speculative_time = time.time() - t0
+    t0 = time.time()
+    model.generate(context, max_new_tokens=max_new_tokens)
+    plain_time = time.time() - t0
+    print(f"speculative: acceptance {stats['acceptance_rate']:.1%}, {stats['tokens_per_pass']:.2f} tokens per forward pass, "
+          f"{speculative_time * 1000:.0f}ms vs {plain_time * 1000:.0f}ms plain ({plain_time / speculative_time:.2f}x)")
+    return decode(out[0].tolist())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or sample the character-level language model")
+    commands = parser.add_subparsers(dest='command')
+    train_parser = commands.add_parser('train', help="train the model, checkpointing to --checkpoint")
+    train_parser.add_argument('--resume', action='store_true', help="continue from the checkpoint if it exists")
+    train_parser.add_argument('--nproc', type=int, default=1, help="data-parallel worker processes on this machine")
+    train_parser.add_argument('--log', help="append per-phase timings and memory peaks to this JSON-lines file")
+    train_parser.add_argument('--profile', help="capture training steps FIRST:LAST with torch.profiler")
+    train_parser.add_argument('--trace', default=profile_path, help="where to write the --profile chrome trace")
+    train_parser.add_argument('--amp', choices=['bfloat16'], help="run the forward pass under autocast in this dtype")
+    train_parser.add_argument('--compile', action='store_true', help="torch.compile the training step (eager fallback)")
+    generate_parser = commands.add_parser('generate', help="sample from a saved checkpoint")
+    generate_parser.add_argument('--prompt', default='', help="text to continue (defaults to a newline)")
+    generate_parser.add_argument('--max-new-tokens', type=int, default=500)
+    generate_parser.add_argument('--int8', action='store_true', help="sample with int8 dynamically quantized linear layers")
+    generate_parser.add_argument('--draft', help="speculative decoding with 'bigram' or a smaller checkpoint as the draft model")
+    generate_parser.add_argument('-k', type=int, default=4, help="tokens proposed by the draft per verification pass")
+    quantize_parser = commands.add_parser('quantize', help="report val loss, size and speed of int8 vs fp32 inference")
+    for p in (generate_parser, quantize_parser):
+        p.add_argument('--embeddings', choices=['bfloat16', 'float16'], help="with int8, also store embeddings in this precision")
+    for p in (train_parser, generate_parser, quantize_parser):
+        p.add_argument('--checkpoint', default=checkpoint_path)
+    args = parser.parse_args()
+    if args.command is not None:
+        checkpoint_path = args.checkpoint
+    if args.command == 'train':
+        log_path = args.log
+        profile_steps = tuple(int(x) for x in args.profile.split(':')) if args.profile else None
+        profile_path = args.trace
+        amp_dtype = getattr(torch, args.amp) if args.amp else None
+        compile_model = args.compile
+
+    if args.command in (None, 'train'):
+        if getattr(args, 'nproc', 1) > 1:
+            spawn_workers(args.nproc, resume=args.resume)
+        else:
+            train(resume=args.command == 'train' and args.resume)
+    if args.command in (None, 'generate'):
+        # generate from the model
+        print(sample(getattr(args, 'prompt', ''), getattr(args, 'max_new_tokens', 500), checkpoint_path,
+                     int8=getattr(args, 'int8', False), embeddings_dtype=getattr(torch, args.embeddings) if getattr(args, 'embeddings', None) else None,
+                     draft=getattr(args, 'draft', None), k=getattr(args, 'k', 4)))
+    if args.command == 'quantize':
+        print(json.dumps(quantization_report(checkpoint_path, getattr(torch, args.embeddings) if args.embeddings else None), indent=2))
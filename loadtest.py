@@ -0,0 +1,471 @@
+"""
+Offline load test for the wine assistant in Gemini+brave.py, against local stand-ins for every upstream.
+
+    python loadtest.py --qps 20 --duration 30 --latency pdp=150,gemini=800 --error-rate pdp=0.05 --out load.json
+
+Stub servers answer the autosuggest, PDP and addToCart calls (one "wine" host,
+like the real API), Brave search, the result pages and Gemini (its REST API,
+streamed or not). Each endpoint has its own median latency (lognormal, spread
+set by --jitter) and share of 503 errors. Payloads are generated from a small
+wine list, or replayed from a fixtures JSON file with any of the keys
+wines, autosuggest, pdp, cart, brave, page, gemini (Brave result URLs are
+always pointed at the local page servers).
+
+The real pipeline is imported and driven open-loop at the target rate: one
+query is started every 1/qps seconds whether or not earlier ones finished, so
+latency is measured from when a query was due and includes any queueing.
+The report has throughput, latency percentiles, the assistant's own stage
+metrics, cache hit rates, and requests vs TCP connections per stub, which
+shows whether connections are pooled and kept alive.
+"""
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ENDPOINTS = ('autosuggest', 'pdp', 'cart', 'brave', 'page', 'gemini')
+DEFAULT_LATENCY = {'autosuggest': 80, 'pdp': 120, 'cart': 150, 'brave': 250, 'page': 200, 'gemini': 700} # ms, median
+WINES = [
+    {'lwin': '1012361', 'name': 'Chateau Margaux 2015', 'vintage': 2015},
+    {'lwin': '1014033', 'name': 'Chateau Latour 2010', 'vintage': 2010},
+    {'lwin': '1098234', 'name': 'Penfolds Grange 2016', 'vintage': 2016},
+    {'lwin': '1121345', 'name': 'Opus One 2018', 'vintage': 2018},
+    {'lwin': '1056789', 'name': 'Tenuta San Guido Sassicaia 2017', 'vintage': 2017},
+    {'lwin': '1034567', 'name': 'Dom Perignon 2012', 'vintage': 2012},
+    {'lwin': '1045678', 'name': 'Antinori Tignanello 2019', 'vintage': 2019},
+    {'lwin': '1067890', 'name': 'Cloudy Bay Sauvignon Blanc 2022', 'vintage': 2022},
+]
+GENERAL_QUESTIONS = [
+    "is 2015 a good vintage for bordeaux",
+    "how long should I cellar barolo",
+    "what food goes with aged riesling",
+]
+
+
+def slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1]}
+
+
+class StubServer(ThreadingHTTPServer):
+    """ local HTTP server that also counts the TCP connections it accepts and how many are open at once """
+    daemon_threads = True
+
+    def __init__(self, name, routes, upstreams):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.name = name
+        self.routes = routes # path prefix -> (endpoint, handler)
+        self.upstreams = upstreams
+        self.lock = threading.Lock()
+        self.connections = self.open = self.peak_open = 0
+        self.requests = Counter()
+        self.errors = Counter()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+            self.open += 1
+            self.peak_open = max(self.peak_open, self.open)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.open -= 1
+        super().shutdown_request(request)
+
+    def stats(self):
+        with self.lock:
+            requests = sum(self.requests.values())
+            return {
+                'server': self.name,
+                'requests': dict(self.requests),
+                'errors': dict(self.errors),
+                'connections': self.connections,
+                'peak_open': self.peak_open,
+                'requests_per_connection': requests / self.connections if self.connections else 0.0,
+            }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, so connection reuse by the client shows up in the counts
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        route = next((r for prefix, r in self.server.routes.items() if url.path.startswith(prefix)), None)
+        if route is None:
+            self.send_error(404)
+            return
+        endpoint, handler = route
+        upstreams = self.server.upstreams
+        with self.server.lock:
+            self.server.requests[endpoint] += 1
+        if random.random() < upstreams.error_rate.get(endpoint, 0):
+            with self.server.lock:
+                self.server.errors[endpoint] += 1
+            upstreams.delay(endpoint)
+            if endpoint == 'gemini':
+                # Google's error shape, so the client raises ServiceUnavailable as it would for the real API
+                self.send(503, {'error': {'code': 503, 'message': 'injected by loadtest', 'status': 'UNAVAILABLE'}})
+            else:
+                self.send(503, {'error': 'injected by loadtest'})
+            return
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        handler(self, url.path, params, body)
+
+    def send(self, status, payload, content_type='application/json'):
+        data = payload.encode('utf-8') if isinstance(payload, str) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunks(self, pieces, gap):
+        # chunked transfer with a pause before each piece, like a model generating its answer
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for piece in pieces:
+            time.sleep(gap)
+            data = piece.encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Upstreams:
+    """ the stub servers plus the payloads, latencies and error rates they serve """
+
+    def __init__(self, fixtures=None, latency=None, error_rate=None, jitter=0.5, pages=5, chunks=8):
+        self.fixtures = fixtures or {}
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.error_rate = error_rate or {}
+        self.jitter = jitter
+        self.chunks = chunks
+        self.wines = {str(w['lwin']): w for w in self.fixtures.get('wines', WINES)}
+        self.wine = StubServer('wine', {
+            '/live-markets/api_buyBid/autosuggestionsearch': ('autosuggest', self.autosuggest),
+            '/live-markets/api_pdp/get': ('pdp', self.pdp),
+            '/live-markets/api_cart/addToCart': ('cart', self.cart),
+        }, self)
+        self.brave = StubServer('brave', {'/res/v1/web/search': ('brave', self.brave_search)}, self)
+        # one server per result page: the assistant keeps a single result per host:port
+        self.pages = [StubServer(f'page{n}', {'/': ('page', self.page)}, self) for n in range(pages)]
+        self.gemini = StubServer('gemini', {'/v1beta/models/': ('gemini', self.generate)}, self)
+
+    @property
+    def servers(self):
+        return [self.wine, self.brave, *self.pages, self.gemini]
+
+    def environ(self):
+        # what Gemini+brave.py reads at import to talk to these servers instead of the real ones
+        return {
+            'CRU_BASE_URL': self.wine.url,
+            'BRAVE_SEARCH_URL': f"{self.brave.url}/res/v1/web/search",
+            'GEMINI_API_ENDPOINT': self.gemini.url,
+            'BRAVE_API_KEY': 'loadtest',
+            'GEMINI_API_KEY': 'loadtest',
+        }
+
+    def delay(self, endpoint, share=1.0):
+        median = self.latency.get(endpoint, 0) / 1000
+        if median > 0:
+            time.sleep(share * random.lognormvariate(math.log(median), self.jitter))
+
+    def matching_wines(self, query):
+        words = {w for w in re.findall(r'\w+', query.lower()) if len(w) > 2}
+        scored = [(len(words & set(re.findall(r'\w+', w['name'].lower()))), w) for w in self.wines.values()]
+        return [w for score, w in sorted(scored, key=lambda s: -s[0]) if score][:10]
+
+    def autosuggest(self, request, path, params, body):
+        self.delay('autosuggest')
+        if 'autosuggest' in self.fixtures:
+            request.send(200, self.fixtures['autosuggest'])
+            return
+        products = [{**w, 'url': f"{self.wine.url}/{slug(w['name'])}"} for w in self.matching_wines(params.get('q', ''))]
+        request.send(200, {'found': bool(products), 'data': [{'type': 'product', 'data': products}]})
+
+    def pdp(self, request, path, params, body):
+        self.delay('pdp')
+        if 'pdp' in self.fixtures:
+            request.send(200, self.fixtures['pdp'])
+            return
+        wine = self.wines.get(params.get('lwin'))
+        if wine is None:
+            request.send(404, {'error': 'unknown lwin'})
+            return
+        request.send(200, {
+            'main_details': {
+                'short_name': wine['name'],
+                'description': f"{wine['name']}, a benchmark wine from the loadtest fixtures.",
+                'image_url': f"{self.wine.url}/media/{wine['lwin']}.jpg",
+                'stock_location': 'London City Bond',
+                'stock_location_eta': '2-3 working days',
+            },
+            'buy_details': [{'product_id': f"9{wine['lwin']}", 'format': '6x75cl', 'unit_qty_info': {'qty_available': 24}}],
+        })
+
+    def cart(self, request, path, params, body):
+        self.delay('cart')
+        if 'cart' in self.fixtures:
+            request.send(200, self.fixtures['cart'])
+            return
+        payload = json.loads(body or b'{}')
+        product_id = str(payload.get('product', ''))
+        wine = self.wines.get(product_id[1:], {'name': 'Unknown wine', 'vintage': None})
+        request.send(200, {'status': 1, 'cart_items': [{
+            'item_id': random.randrange(10 ** 6),
+            'product_id': product_id,
+            'name': wine['name'],
+            'condition_status': 'verified',
+            'price': 1250.0,
+            'vintage': wine.get('vintage'),
+            'format': '6x75cl',
+            'eta': {'stock_location': 'London City Bond', 'eta_val': '2-3 working days'},
+            'warehouse': {'name': 'LCB'},
+        }]})
+
+    def brave_search(self, request, path, params, body):
+        self.delay('brave')
+        query = params.get('q', '')
+        results = self.fixtures.get('brave', {}).get('web', {}).get('results') or [{
+            'title': f"{query} - review {n + 1}",
+            'description': f"What critic {n + 1} says about {query}.",
+            'extra_snippets': [f"{query} is drinking well now and should keep for {n + 5} years, says critic {n + 1}."],
+        } for n in range(int(params.get('count', 5)))]
+        results = [{**r, 'url': f"{self.pages[n % len(self.pages)].url}/page/{slug(query) or 'result'}"}
+                   for n, r in enumerate(results)]
+        request.send(200, {'web': {'results': results}})
+
+    def page(self, request, path, params, body):
+        self.delay('page')
+        topic = path.rsplit('/', 1)[-1].replace('-', ' ')
+        html = self.fixtures.get('page') or (
+            f"<html><head><title>{topic}</title></head><body><nav>Home Reviews Shop</nav>"
+            f"<p>Tasting notes from {request.server.name} on {topic}: dark fruit, firm tannins and a long finish.</p>"
+            f"<p>{topic} has been priced steadily at auction over the last year.</p>"
+            f"<p>Unrelated paragraph about the weather in the vineyard this spring.</p></body></html>")
+        request.send(200, html, 'text/html; charset=utf-8')
+
+    def generate(self, request, path, params, body):
+        prompt = json.loads(body or b'{}').get('contents', [{}])[0].get('parts', [{}])[0].get('text', '')
+        answer = self.fixtures.get('gemini') or (
+            f"Here is a summary based on the {len(prompt)} characters of context provided. " * 4).strip()
+        if ':streamGenerateContent' not in path:
+            self.delay('gemini')
+            request.send(200, {'candidates': [{'content': {'parts': [{'text': answer}], 'role': 'model'},
+                                               'finishReason': 'STOP', 'index': 0}]})
+            return
+        # the REST client reads a streamed answer as one JSON array of responses
+        size = math.ceil(len(answer) / self.chunks)
+        pieces = [answer[i:i + size] for i in range(0, len(answer), size)]
+        chunks = [json.dumps({'candidates': [{'content': {'parts': [{'text': piece}], 'role': 'model'}, 'index': 0}]})
+                  for piece in pieces]
+        gap = random.lognormvariate(math.log(max(self.latency.get('gemini', 0), 1) / 1000), self.jitter) / len(chunks)
+        request.send_chunks(['[' + chunks[0]] + [',' + c for c in chunks[1:]] + [']'], gap)
+
+    def stats(self):
+        return [server.stats() for server in self.servers]
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def load_assistant(path):
+    # the script's name isn't a valid module name, so it's loaded from its path; its helpers sit next to it
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location('wine_assistant', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def default_queries(wines):
+    queries = []
+    for w in wines:
+        queries += [
+            f"{w['name']} stock",
+            f"{w['name']} details",
+            f"{w['name']} image",
+            f"Add 1 case of {w['name']} (6x75cl) to my cart",
+            w['name'],
+        ]
+    # general questions that no wine matches, answered from the web context alone
+    queries += GENERAL_QUESTIONS
+    return [{'query': q} for q in queries]
+
+
+def read_queries(path):
+    # the --batch format: JSON objects with query (and session), JSON strings or plain lines
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line.strip()
+            records.append(record if isinstance(record, dict) else {'query': record})
+    return records
+
+
+def run_one(wine, record, session, due):
+    # one query through the same entry point as --batch, so every intent takes its real path
+    started = time.perf_counter()
+    outcome, intent = 'ok', wine.classify_user_intent(record['query'])
+    try:
+        result = wine.answer_query(record['query'], record.get('session', session))
+        if result['wine_data'].startswith('❌') or result['response'].startswith('❌'):
+            outcome = 'failed'
+    except Exception:
+        outcome = 'error'
+    finished = time.perf_counter()
+    return {'outcome': outcome, 'intent': intent, 'latency': finished - due, 'service': finished - started}
+
+
+def drive(wine, records, qps, duration, concurrency=64, sessions=50):
+    total = max(1, int(qps * duration))
+    futures = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i in range(total):
+            due = start + i / qps
+            time.sleep(max(0.0, due - time.perf_counter()))
+            futures.append(pool.submit(run_one, wine, records[i % len(records)], f"load-{i % sessions}", due))
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+    outcomes = Counter(r['outcome'] for r in results)
+    return {
+        'offered_qps': qps,
+        'requests': total,
+        'elapsed': elapsed,
+        'throughput': total / elapsed,
+        'outcomes': dict(outcomes),
+        'latency': percentiles([r['latency'] for r in results]),
+        'service_time': percentiles([r['service'] for r in results]),
+        'latency_by_intent': {intent: percentiles([r['latency'] for r in results if r['intent'] == intent])
+                              for intent in sorted({r['intent'] for r in results})},
+    }
+
+
+def print_report(report):
+    run = report['run']
+    outcomes = run['outcomes']
+    print(f"\noffered {run['offered_qps']:.1f} qps, achieved {run['throughput']:.2f} qps: "
+          f"{run['requests']} queries in {run['elapsed']:.1f}s, "
+          f"{outcomes.get('failed', 0)} failed answers, {outcomes.get('error', 0)} errors")
+    for name, values in [('latency', run['latency']), ('service_time', run['service_time']),
+                         *run['latency_by_intent'].items()]:
+        print(f"{name:>13}: " + ' '.join(f"{q}={v:.3f}s" for q, v in values.items()))
+
+    print(f"\n{'stub':<8}{'requests':>10}{'errors':>8}{'conns':>8}{'peak open':>11}{'req/conn':>10}")
+    for s in report['stubs']:
+        print(f"{s['server']:<8}{sum(s['requests'].values()):>10}{sum(s['errors'].values()):>8}"
+              f"{s['connections']:>8}{s['peak_open']:>11}{s['requests_per_connection']:>10.1f}")
+
+    print("\n" + report['stages'])
+    for c in report['caches']:
+        print(f"cache {c['name']}: hit rate {c['hit_rate']:.0%} ({c['hits']} hits, {c['stale_hits']} stale, "
+              f"{c['misses']} misses)")
+
+
+def parse_endpoint_values(text):
+    # "pdp=150,gemini=800" -> {'pdp': 150.0, 'gemini': 800.0}
+    values = {}
+    for pair in filter(None, (text or '').split(',')):
+        name, _, value = pair.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r}, expected one of {', '.join(ENDPOINTS)}")
+        values[name] = float(value)
+    return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the wine assistant against local stub upstreams")
+    parser.add_argument('--qps', type=float, default=10, help="queries started per second")
+    parser.add_argument('--duration', type=float, default=20, help="seconds to keep starting queries")
+    parser.add_argument('--concurrency', type=int, default=64, help="most queries in flight at once")
+    parser.add_argument('--queries', help="JSONL file in the --batch format (default: generated from the wine list)")
+    parser.add_argument('--fixtures', help="JSON file of recorded payloads: wines, autosuggest, pdp, cart, brave, page, gemini")
+    parser.add_argument('--latency', type=parse_endpoint_values, default={},
+                        help=f"median ms per endpoint, e.g. pdp=150,gemini=800 (defaults {DEFAULT_LATENCY})")
+    parser.add_argument('--jitter', type=float, default=0.5, help="lognormal sigma of stub latencies (0 = fixed)")
+    parser.add_argument('--error-rate', type=parse_endpoint_values, default={},
+                        help="share of 503 responses per endpoint, e.g. pdp=0.05,brave=0.1")
+    parser.add_argument('--no-cache', action='store_true', help="make every autosuggest, PDP and Gemini lookup a miss")
+    parser.add_argument('--keep-rate-limits', action='store_true',
+                        help="keep the assistant's per-service rate limits (by default they are lifted)")
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Gemini+brave.py'))
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--out', help="also write the report as JSON to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    fixtures = {}
+    if args.fixtures:
+        with open(args.fixtures, 'r', encoding='utf-8') as f:
+            fixtures = json.load(f)
+    upstreams = Upstreams(fixtures, args.latency, args.error_rate, args.jitter)
+    # point the assistant at the stubs, and keep it away from on-disk caches, carts and catalogues
+    os.environ.update(upstreams.environ(), CRU_CACHE_DB='', CRU_CART_DB='', CRU_CATALOG='')
+    wine = load_assistant(args.script)
+    if not args.keep_rate_limits:
+        for limiter in wine.rate_limiters.values():
+            limiter.rate = 0
+    if args.no_cache:
+        for cache in (wine.search_cache, wine.pdp_cache, wine.gemini_cache):
+            cache.ttl = cache.stale_ttl = 0
+
+    records = read_queries(args.queries) if args.queries else default_queries(list(upstreams.wines.values()))
+    print(f"{len(records)} queries against stubs at {upstreams.wine.url} (wine), {upstreams.brave.url} (brave), "
+          f"{upstreams.gemini.url} (gemini)", file=sys.stderr)
+    run = drive(wine, records, args.qps, args.duration, args.concurrency)
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k != 'script'},
+        'run': run,
+        'stubs': upstreams.stats(),
+        'stages': wine.metrics.summary(),
+        'caches': [c.stats() for c in (wine.search_cache, wine.pdp_cache, wine.gemini_cache)],
+        'metrics': wine.metrics.snapshot(),
+    }
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    upstreams.close()
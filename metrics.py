@@ -0,0 +1,164 @@
+"""
+In-process metrics for the wine assistant: latency/size histograms, counters and a per-request trace id.
+
+    with metrics.timer('stage_seconds', stage='pdp'):
+        ...
+    metrics.inc('upstream_responses_total', upstream='pdp', status=200)
+    metrics.snapshot()   # count/sum/p50/p95/p99 per series, as a dict
+    metrics.prometheus() # Prometheus text exposition format
+
+Histograms keep Prometheus-style cumulative buckets for export, plus the most
+recent samples for percentiles. The trace id lives in a context variable, so
+it follows a request into asyncio tasks; a call handed to a thread pool only
+sees it when it runs inside contextvars.copy_context().run, as the assistant's
+stage and page fetches do. Other threads (cache refreshes, for one) log '-'.
+TraceIdFilter stamps it on log records.
+"""
+import bisect
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+recent_samples = 2048 # per series, for the percentiles
+
+trace_id = contextvars.ContextVar('trace_id', default='-')
+
+
+def new_trace():
+    tid = uuid.uuid4().hex[:16]
+    trace_id.set(tid)
+    return tid
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id.get()
+        return True
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=recent_samples)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Registry:
+    """ named histograms and counters, each split by label values """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = defaultdict(float)
+        self.collectors = [] # callables returning [(name, labels dict, value)], read at export time
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        # time the block into histogram `name`; exceptions also count towards name_errors_total
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.inc(name.removesuffix('_seconds') + '_errors_total', error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [{
+                'name': name,
+                'labels': dict(labels),
+                'count': h.count,
+                'sum': h.sum,
+                'p50': h.quantile(0.5),
+                'p95': h.quantile(0.95),
+                'p99': h.quantile(0.99),
+            } for (name, labels), h in sorted(self.histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+        for collect in self.collectors:
+            counters += [{'name': name, 'labels': labels, 'value': value} for name, labels, value in collect()]
+        return {'time': time.time(), 'histograms': histograms, 'counters': counters}
+
+    def summary(self):
+        # one line per latency series, for people rather than scrapers
+        lines = []
+        for h in self.snapshot()['histograms']:
+            if not h['name'].endswith('_seconds'):
+                continue
+            labels = ','.join(f"{k}={v}" for k, v in h['labels'].items())
+            lines.append(f"{h['name']}{{{labels}}}: n={h['count']} p50={h['p50']:.3f}s "
+                         f"p95={h['p95']:.3f}s p99={h['p99']:.3f}s")
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        with self.lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                declare(name, 'histogram')
+                cumulative = 0
+                for le, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += count
+                    lines.append(f"{self.prefix}{name}_bucket{format_labels(labels, le=le)} {cumulative}")
+                lines.append(f"{self.prefix}{name}_sum{format_labels(labels)} {h.sum}")
+                lines.append(f"{self.prefix}{name}_count{format_labels(labels)} {h.count}")
+            counters = sorted(self.counters.items())
+        for collect in self.collectors:
+            counters += [((name, label_key(labels)), value) for name, labels, value in collect()]
+        for (name, labels), value in counters:
+            declare(name, 'counter' if name.endswith('_total') else 'gauge')
+            lines.append(f"{self.prefix}{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
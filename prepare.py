@@ -0,0 +1,111 @@
+"""
+Pre-tokenize text shards into a compact token file for chatgpt.py.
+
+    python prepare.py input.txt [more.txt ...] --out input.bin [--tokenizer bpe --vocab-size 512]
+
+Writes the token ids as raw uint8/uint16 (input.bin) next to the vocabulary
+(input.meta.json), so training can memory-map the corpus instead of encoding
+it on every start. The vocabulary is either one token per character or
+byte-pair merges learned by bpe.py.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from bpe import Tokenizer
+
+chunk_chars = 1 << 24 # characters read per chunk while streaming a shard
+
+
+def meta_path(token_path):
+    return os.path.splitext(token_path)[0] + '.meta.json'
+
+
+def read_chunks(shards):
+    # stream every shard in fixed-size chunks so we never hold a whole corpus in memory
+    for shard in shards:
+        with open(shard, 'r', encoding='utf-8') as f:
+            while True:
+                chunk = f.read(chunk_chars)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def prepare(shards, token_path, tokenizer='char', vocab_size=512):
+    if tokenizer == 'bpe':
+        return prepare_bpe(shards, token_path, vocab_size)
+
+    # first pass: here are all the unique characters that occur in the shards
+    chars = set()
+    for chunk in read_chunks(shards):
+        chars.update(chunk)
+    chars = sorted(chars)
+    vocab_size = len(chars)
+    if vocab_size > 1 << 16:
+        raise ValueError(f"vocabulary of {vocab_size} characters does not fit in uint16")
+    dtype = np.uint8 if vocab_size <= 1 << 8 else np.uint16
+
+    # lookup table from unicode code point to token id, so encoding is one numpy gather per chunk
+    lut = np.zeros(ord(chars[-1]) + 1, dtype=dtype)
+    lut[[ord(c) for c in chars]] = np.arange(vocab_size)
+
+    # second pass: encode and append to the token file
+    num_tokens = 0
+    with open(token_path, 'wb') as f:
+        for chunk in read_chunks(shards):
+            codes = np.frombuffer(chunk.encode('utf-32-le'), dtype=np.uint32)
+            lut[codes].tofile(f)
+            num_tokens += len(codes)
+
+    return write_meta(token_path, shards, num_tokens, dtype, tokenizer='char', vocab_size=vocab_size, chars=chars)
+
+
+def prepare_bpe(shards, token_path, vocab_size):
+    if vocab_size > 1 << 16:
+        raise ValueError(f"vocabulary of {vocab_size} tokens does not fit in uint16")
+    # first pass learns the merges, second pass encodes with them (cached per word)
+    tok = Tokenizer.train(read_chunks(shards), vocab_size)
+    dtype = np.uint8 if tok.vocab_size <= 1 << 8 else np.uint16
+    num_tokens = 0
+    with open(token_path, 'wb') as f:
+        for chunk in read_chunks(shards):
+            ids = np.array(tok.encode(chunk), dtype=dtype)
+            ids.tofile(f)
+            num_tokens += len(ids)
+
+    return write_meta(token_path, shards, num_tokens, dtype, tokenizer='bpe', vocab_size=tok.vocab_size,
+                      merges=[list(pair) for pair in tok.merges])
+
+
+def write_meta(token_path, shards, num_tokens, dtype, **vocab):
+    meta = {
+        **vocab,
+        'dtype': np.dtype(dtype).name,
+        'num_tokens': num_tokens,
+        'shards': list(shards),
+    }
+    with open(meta_path(token_path), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return meta
+
+
+def load_tokens(token_path):
+    # memory-map the token file; pages are only read when a batch touches them
+    with open(meta_path(token_path), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    data = np.memmap(token_path, dtype=meta['dtype'], mode='r', shape=(meta['num_tokens'],))
+    return data, meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-tokenize text shards for chatgpt.py")
+    parser.add_argument('shards', nargs='+', help="text files to encode, in order")
+    parser.add_argument('--out', default='input.bin', help="token file to write")
+    parser.add_argument('--tokenizer', choices=['char', 'bpe'], default='char')
+    parser.add_argument('--vocab-size', type=int, default=512, help="target vocabulary size for --tokenizer bpe")
+    args = parser.parse_args()
+    meta = prepare(args.shards, args.out, args.tokenizer, args.vocab_size)
+    print(f"wrote {meta['num_tokens']:,} tokens ({meta['dtype']}, vocab {meta['vocab_size']}) to {args.out}")
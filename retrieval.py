@@ -0,0 +1,107 @@
+"""
+Boil web search results down to the passages that best answer a query, within a token budget.
+
+    sources = [{'title': ..., 'url': ..., 'snippets': [...], 'passages': split_passages(html_to_text(page))}]
+    context, used = pack_context("is 2015 a good vintage for margaux", sources, budget=1500)
+
+Passages are ranked against the query with BM25. Search snippets are always
+candidates (the search engine picked them for this query); page passages need
+at least one query term. The best ones are taken greedily until the budget is
+spent and written out grouped by source as "[n] title (url)" blocks, so the
+answer can cite them.
+"""
+import html
+import math
+import re
+from collections import Counter
+
+passage_chars = 600 # longest passage; longer paragraphs are cut at sentence ends
+chars_per_token = 4 # rough estimate for English text, good enough for budgeting
+# query words that say nothing about what a passage should contain
+stopwords = set("""a an and are as at be but by can do does for from has have how i in is it its me my of on or
+should that the their this to was what when where which who why will with you your""".split())
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / chars_per_token)
+
+
+def html_to_text(page):
+    page = re.sub(r'(?is)<(script|style|noscript|svg|head|nav|footer)\b.*?</\1\s*>', ' ', page)
+    page = re.sub(r'(?s)<!--.*?-->', ' ', page)
+    page = re.sub(r'(?i)<(?:br|/p|/div|/li|/h[1-6]|/tr|/section|/article)\b[^>]*>', '\n', page)
+    page = html.unescape(re.sub(r'<[^>]+>', ' ', page))
+    lines = (' '.join(line.split()) for line in page.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def split_passages(text, size=passage_chars):
+    # one passage per paragraph, long paragraphs cut into runs of whole sentences;
+    # lines of a few words are mostly menus and buttons, so they're dropped
+    passages = []
+    for line in text.splitlines():
+        if len(line.split()) < 4:
+            continue
+        current = ''
+        for sentence in re.split(r'(?<=[.!?])\s+', line):
+            if current and len(current) + len(sentence) + 1 > size:
+                passages.append(current)
+                current = ''
+            current = f"{current} {sentence}".strip()[:2 * size]
+        passages.append(current)
+    return passages
+
+
+def terms(text):
+    return re.findall(r'\w+', text.lower())
+
+
+def bm25(query, passages, k1=1.5, b=0.75):
+    query_terms = set(terms(query)) - stopwords
+    docs = [Counter(terms(p)) for p in passages]
+    if not docs:
+        return []
+    lengths = [sum(d.values()) for d in docs]
+    avg_length = sum(lengths) / len(docs) or 1
+    df = Counter(t for d in docs for t in query_terms & d.keys())
+    idf = {t: math.log(1 + (len(docs) - n + 0.5) / (n + 0.5)) for t, n in df.items()}
+    return [
+        sum(idf[t] * d[t] * (k1 + 1) / (d[t] + k1 * (1 - b + b * length / avg_length)) for t in query_terms & d.keys())
+        for d, length in zip(docs, lengths)
+    ]
+
+
+def pack_context(query, sources, budget):
+    # returns the context text and the sources it cites, numbered as in the text
+    candidates = []
+    for i, source in enumerate(sources):
+        for text in source.get('snippets', []):
+            text = html_to_text(text)
+            if text:
+                candidates.append((i, text, True))
+        for text in source.get('passages', []):
+            candidates.append((i, text, False))
+    scores = bm25(query, [text for _, text, _ in candidates])
+
+    chosen, seen = {}, set()
+    spent = 0
+    order = sorted(range(len(candidates)), key=lambda c: (-scores[c], not candidates[c][2]))
+    for c in order:
+        i, text, snippet = candidates[c]
+        if (not snippet and scores[c] <= 0) or text in seen:
+            continue
+        header = 0 if i in chosen else estimate_tokens(f"[{i}] {sources[i].get('title')} ({sources[i].get('url')})")
+        cost = header + estimate_tokens(text)
+        if spent + cost > budget:
+            continue
+        spent += cost
+        seen.add(text)
+        chosen.setdefault(i, []).append((c, text))
+
+    blocks, used = [], []
+    for i in sorted(chosen):
+        used.append(sources[i])
+        # passages keep their original order within a source so they still read naturally
+        body = '\n'.join(text for _, text in sorted(chosen[i]))
+        blocks.append(f"[{len(used)}] {sources[i].get('title')} ({sources[i].get('url')})\n{body}")
+    return '\n\n'.join(blocks), used
@@ -0,0 +1,180 @@
+"""
+Local sampling service for a checkpoint trained with chatgpt.py.
+
+    python serve.py --checkpoint ckpt.pt --port 8000
+    curl -N -d '{"prompt": "ROMEO:", "max_new_tokens": 200}' localhost:8000/generate
+
+Requests are queued and packed into shared forward passes of the model (continuous
+batching): every step samples one token for each active request, finished requests
+leave the batch and waiting ones take their slots. Generated text is streamed back
+as it is sampled.
+"""
+import argparse
+import codecs
+import collections
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+import chatgpt
+
+
+class Request:
+    """ one prompt being sampled; iterate over it to stream the generated text """
+
+    def __init__(self, tokens, max_new_tokens):
+        self.tokens = tokens # prompt followed by everything sampled so far
+        self.remaining = max_new_tokens
+        self.cancelled = False
+        # a byte-pair token can end part-way through a utf-8 character
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.error = None
+        self.stream = queue.Queue()
+
+    def __iter__(self):
+        while True:
+            piece = self.stream.get()
+            if piece is None:
+                break
+            yield piece
+        if self.error is not None:
+            raise self.error
+
+    def result(self):
+        return ''.join(self)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SamplingServer:
+    """ samples many requests at once from one model, admitting new ones as others finish """
+
+    def __init__(self, path=None, max_batch=64, int8=False):
+        chatgpt.load_checkpoint(path)
+        self.model = chatgpt.model.eval()
+        if int8:
+            self.model = chatgpt.quantize(self.model) # smaller weights per replica, faster on memory-bound CPUs
+        self.max_batch = max_batch
+        self.waiting = collections.deque()
+        self.active = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, max_new_tokens):
+        try:
+            tokens = chatgpt.encode_prompt(prompt)
+        except KeyError as e:
+            raise ValueError(f"prompt contains a character outside the vocabulary: {e}") from None
+        request = Request(tokens, max_new_tokens)
+        if max_new_tokens <= 0:
+            request.stream.put(None)
+            return request
+        with self.cond:
+            self.waiting.append(request)
+            self.cond.notify()
+        return request
+
+    def close(self):
+        # stop the engine thread between steps; torch must not be mid-op when the interpreter exits
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        for request in self.active + list(self.waiting):
+            request.error = RuntimeError("sampling server closed")
+            request.stream.put(None)
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.active and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                while self.waiting and len(self.active) < self.max_batch:
+                    self.active.append(self.waiting.popleft())
+            try:
+                self.step()
+            except Exception as e:
+                # fail the requests in flight rather than leaving their streams hanging
+                for request in self.active:
+                    request.error = e
+                    request.stream.put(None)
+                self.active = []
+
+    @torch.no_grad()
+    def step(self):
+        # every row is the last block_size tokens of one request, left-aligned so positions start
+        # at 0 like in generate(); shorter rows are padded on the right, which causal attention
+        # never lets the real positions see
+        windows = [torch.tensor(r.tokens[-chatgpt.block_size:]) for r in self.active]
+        lengths = torch.tensor([len(w) for w in windows])
+        idx = pad_sequence(windows, batch_first=True).to(chatgpt.device) # (B, T)
+        logits, _ = self.model(idx)
+        logits = logits[torch.arange(len(windows)), lengths - 1] # (B, C) at each row's last real position
+        probs = F.softmax(logits, dim=-1)
+        next_tokens = torch.multinomial(probs, num_samples=1)[:, 0].tolist()
+
+        active = []
+        for request, token in zip(self.active, next_tokens):
+            request.tokens.append(token)
+            request.remaining -= 1
+            if request.remaining > 0 and not request.cancelled:
+                request.stream.put(request.decoder.decode(chatgpt.token_bytes(token)))
+                active.append(request)
+            else:
+                request.stream.put(request.decoder.decode(chatgpt.token_bytes(token), final=True))
+                request.stream.put(None)
+        self.active = active
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_error(404)
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                request = server.submit(body.get('prompt', ''), int(body.get('max_new_tokens', 100)))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            try:
+                for piece in request:
+                    self.wfile.write(piece.encode('utf-8'))
+                    self.wfile.flush()
+            except OSError:
+                request.cancel() # client went away
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a chatgpt.py checkpoint over HTTP")
+    parser.add_argument('--checkpoint', default=chatgpt.checkpoint_path)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=64, help="requests sampled together in one forward pass")
+    parser.add_argument('--int8', action='store_true', help="serve with int8 dynamically quantized linear layers")
+    args = parser.parse_args()
+    server = SamplingServer(args.checkpoint, max_batch=args.max_batch, int8=args.int8)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print(f"serving {args.checkpoint} on http://{args.host}:{args.port}/generate")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()